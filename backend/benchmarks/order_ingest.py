@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""Benchmark inserting new orders one transaction per order versus grouped by the order ingestor.
+
+Many client threads submit orders concurrently, similar to concurrent /order/make/ requests.
+The benchmark uses a temporary SQLite database file, so the measured commit costs are realistic.
+
+Usage: python benchmarks/order_ingest.py [--threads N] [--orders N]
+"""
+
+import argparse
+import tempfile
+import threading
+import time
+
+from decimal import Decimal
+from pathlib import Path
+
+from pizzaapp.app import registry
+from pizzaapp.app.database import connect
+from pizzaapp.app.ingest import OrderIngestor, run_ingest_thread
+from pizzaapp.app.order import insert_orders
+from pizzaapp.app.tables import Order, OrderItem
+
+
+def make_order() -> Order:
+    order = Order(
+        first_name="Max", last_name="Muster", street="Hauptstr. 1", city="Berlin", postal_code="10115"
+    )
+    order.items.append(OrderItem(item_id=None, unit_price=Decimal("6.99"), quantity=2))
+    return order
+
+
+def run_clients(threads: int, orders: int, insert_order) -> float:
+    """Let each client thread insert orders and return the achieved orders per second.
+
+    Errors of client threads are raised again, so that failed runs don't report a rate.
+    """
+    errors = []
+
+    def client():
+        try:
+            for _ in range(orders):
+                insert_order(make_order())
+        except Exception as error:
+            errors.append(error)
+
+    clients = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    duration = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return threads * orders / duration
+
+
+def bench_single_commits(engine, threads: int, orders: int) -> float:
+    def insert_order(order):
+        with engine.begin() as connection:
+            insert_orders(connection, [order])
+
+    return run_clients(threads, orders, insert_order)
+
+
+def bench_ingestor(engine, threads: int, orders: int, batch_size: int, batch_window: float) -> float:
+    ingestor = OrderIngestor(engine, batch_size, batch_window)
+    kill_event = threading.Event()
+    ingest_thread = threading.Thread(target=run_ingest_thread, args=(ingestor, kill_event, 0.05))
+    ingest_thread.start()
+
+    def insert_order(order):
+        ingestor.submit(order).result()
+
+    try:
+        return run_clients(threads, orders, insert_order)
+    finally:
+        kill_event.set()
+        ingest_thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark order insertion throughput.")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--orders", type=int, default=100, help="orders inserted per client thread")
+    parser.add_argument("--batch-size", type=int, default=64, help="ingestor batch size")
+    parser.add_argument("--batch-window-ms", type=int, default=5, help="ingestor batch window")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = connect(Path(directory, "bench.sqlite3").as_posix(), False)
+        registry.metadata.create_all(bind=engine)
+
+        before = bench_single_commits(engine, args.threads, args.orders)
+        print(f"One transaction per order: {before:8.1f} orders/sec")
+        after = bench_ingestor(
+            engine, args.threads, args.orders, args.batch_size, args.batch_window_ms / 1000
+        )
+        print(f"Order ingestor:            {after:8.1f} orders/sec")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,22 +8,50 @@ from queue import Queue
 
 import arrow
 
-from box import Box
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
+from pizzaapp.app import archive
 from pizzaapp.app import auth
+from pizzaapp.app import compression
+from pizzaapp.app import config
+from pizzaapp.app import defaults
 from pizzaapp.app import engine
+from pizzaapp.app import ingest
 from pizzaapp.app import order
+from pizzaapp.app import stats
 from pizzaapp.app import store
+from pizzaapp.app import sweep
 from pizzaapp.app import utils
-from pizzaapp.app.catalog import Catalog
+from pizzaapp.app import catalog as catalog_helper
+from pizzaapp.app.cache import BoundedCache
+from pizzaapp.app.catalog import CatalogRefresher, Speciality
+from pizzaapp.app.dispatch import DispatchIndex
+from pizzaapp.app.exceptions import PasswordVerifierBusy
+from pizzaapp.app.kitchen import KitchenView
+from pizzaapp.app.password import PasswordVerifier
+from pizzaapp.app.progress_hub import ProgressHub
 from pizzaapp.app.store import StoreOperation
 from pizzaapp.app.tables import confirm_required_tables_exist
 from pizzaapp.app.utils import error_response
 
-catalog = Catalog(engine)
+catalog_refresher = CatalogRefresher(engine)
+kitchen_view = KitchenView(engine)
+dispatch_index = DispatchIndex(engine)
+password_verifier = PasswordVerifier(
+    defaults.PASSWORD_WORKERS, defaults.PASSWORD_MAX_PENDING, defaults.PASSWORD_VERIFY_TIMEOUT
+)
+order_ingestor = ingest.OrderIngestor(
+    engine,
+    config.orders.batch_size,
+    config.orders.batch_window_ms / 1000,
+    on_insert=kitchen_view.invalidate,
+)
+
+progress_hub = ProgressHub(defaults.PROGRESS_MAX_SUBSCRIPTIONS)
+progress_cache = BoundedCache(defaults.PROGRESS_CACHE_SIZE)
 
 store_queue = Queue()
 delivery_user_locks = {}
@@ -32,88 +60,343 @@ app = Flask("PizzaApp")
 kill_event = threading.Event()  # Kill event for threads to listen on.
 
 
+@app.after_request
+def compress_response(response):
+    """Compress response bodies if the client accepts it."""
+    return compression.compress_response(request, response)
+
+
 @app.route("/get/catalog/")
 def get_catalog():
-    """Get the product catalog as JSON."""
-    catalog_json = catalog.to_json()
-    return catalog_json
+    """Get the product catalog as JSON.
+
+    The catalog is served from its pre-encoded (and pre-compressed) bytes. If the client already
+    has the current catalog (If-None-Match matches the ETag) an empty 304 response is sent.
+    """
+    catalog = catalog_refresher.catalog
+    encoding = compression.choose_encoding(request)
+    # Each content encoding is a different representation and thus needs its own ETag.
+    etag = catalog.etag if encoding is None else f"{catalog.etag}-{encoding}"
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif encoding is None:
+        response = Response(catalog.encoded_json, mimetype="application/json")
+    else:
+        response = Response(catalog.compressed_json[encoding], mimetype="application/json")
+        response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = defaults.CATALOG_MAX_AGE
+    return response
+
+
+@app.route("/get/catalog/search/")
+def get_catalog_search():
+    """Search catalog items by text and filter them by specialities.
+
+    Query arguments: q (search text), vegetarian, vegan, spicy (boolean filters) and limit.
+    """
+    catalog = catalog_refresher.catalog
+    query = request.args.get("q", "")
+    limit = request.args.get("limit", defaults.CATALOG_SEARCH_MAX_RESULTS, type=int)
+    limit = max(1, min(limit, defaults.CATALOG_SEARCH_MAX_RESULTS))
+
+    specialities = Speciality(0)
+    for name, flag in (
+        ("vegetarian", Speciality.VEGETARIAN),
+        ("vegan", Speciality.VEGAN),
+        ("spicy", Speciality.SPICY),
+    ):
+        required = utils.get_bool_arg(request, name)
+        if required is None:
+            return error_response(400)
+        if required:
+            specialities |= flag
+
+    items = catalog.search_index.search(query, specialities, limit)
+    items_json = []
+    for item in items:
+        item_json = catalog_helper.item_to_json(item)
+        item_json["category_id"] = item.category_id
+        items_json.append(item_json)
+    return {"version": catalog.version, "items": items_json}
+
+
+@app.route("/get/catalog/changes/")
+def get_catalog_changes():
+    """Get all catalog items which changed since the catalog version passed in the since argument."""
+    since = request.args.get("since", type=int)
+    if since is None:
+        return error_response(400)
+    catalog = catalog_refresher.catalog
+    return catalog.changes_to_json(since)
 
 
 @app.route("/order/make/", methods=["POST"])
 def order_make():
     """Hand in a new order."""
-    body = utils.get_body_box(request)
+    body = utils.get_body_json(request)
     if body is None:
         return error_response(400)
-    new_order = order.get_new_order(catalog, body)
+    new_order = order.get_new_order(catalog_refresher.catalog, body)
     if new_order is None:
         logger.info("Order request json is invalid.")
         return error_response(400, "order_not_valid")
 
-    # store_operation = StoreOperation(store.simple_store, (new_order,))
-    # store_queue.put_nowait(store_operation)
-    with Session(engine) as session:
-        session.add(new_order)
-        session.commit() 
-        order_id = new_order.order_id
-    logger.debug("Added order store operation to background queue.")
+    # The order is inserted together with other orders arriving at the same time.
+    order_future = order_ingestor.submit(new_order)
+    try:
+        order_id = order_future.result(timeout=defaults.ORDER_INGEST_TIMEOUT)
+    except Exception:
+        # The future raises the error with which its group of orders failed, or a timeout.
+        logger.error("New order couldn't be inserted.")
+        return error_response(500)
+    logger.debug(f"Inserted new order {order_id}.")
     return {"order_id": order_id}, 200
 
 
+@app.route("/order/make_batch/", methods=["POST"])
+def order_make_batch():
+    """Hand in multiple new orders at once.
+
+    Valid orders are inserted in a single transaction. The response contains a result for each
+    order in the same order as the orders were sent: either the order id or an error.
+    """
+    body = order.new_order_batch_validator.validate(utils.get_body_json(request))
+    if body is None:
+        return error_response(400)
+
+    catalog = catalog_refresher.catalog
+    new_orders = [order.get_new_order(catalog, order_body) for order_body in body["orders"]]
+    try:
+        with engine.begin() as connection:
+            results = order.insert_order_batch(connection, new_orders)
+    except SQLAlchemyError:
+        logger.exception("New orders of a batch couldn't be inserted.")
+        return error_response(500)
+    kitchen_view.invalidate()
+
+    inserted_count = sum(1 for result in results if "order_id" in result)
+    logger.debug(f"Inserted {inserted_count} of {len(results)} orders of a batch order request.")
+    return {"orders": results}, 200
+
+
 @app.route("/order/update/progress/", methods=["POST"])
 def order_update_progress():
+    """Update the progress of an order.
+
+    If the body contains the version of the order the client knows, the update is rejected
+    with 409 if the order was updated by someone else in the meantime.
+    """
     bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
     if bearer_token is None:
         return error_response(400)
-    body = utils.get_body_box(request)
+    body = order.update_progress_validator.validate(utils.get_body_json(request))
     if body is None:
         return error_response(400)
-    body_valid = order.check_update_progress_body(body)
-    if not body_valid:
+
+    with Session(engine) as session:
+        if not auth.check_access_token(session, bearer_token):
+            return error_response(401, "invalid_access_token")
+
+    with engine.begin() as connection:
+        results = order.apply_progress_updates(connection, [order.get_progress_update(body)])
+    order.publish_progress_updates(results, progress_hub, progress_cache)
+    kitchen_view.invalidate()
+
+    result = results[0]
+    if result.version is None:
+        return error_response(400)
+    if not result.updated:
+        return error_response(409, "order_version_conflict", {"version": result.version})
+    return result.response_json()
+
+
+@app.route("/order/update/progress_bulk/", methods=["POST"])
+def order_update_progress_bulk():
+    """Update the progress of multiple orders in a single transaction.
+
+    Each update is applied on its own, see order_update_progress. The response contains
+    a result for each update in the same order as the updates were sent.
+    """
+    bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
+    if bearer_token is None:
+        return error_response(400)
+    body = order.bulk_update_progress_validator.validate(utils.get_body_json(request))
+    if body is None:
         return error_response(400)
 
     with Session(engine) as session:
         if not auth.check_access_token(session, bearer_token):
             return error_response(401, "invalid_access_token")
-        existing_order = order.get_existing_order(session, body.order_id)
-        if not existing_order:
-            return error_response(400)
-        store_operation = StoreOperation(order.update_progress, (existing_order, body.new_progress))
-        store_queue.put_nowait(store_operation)
 
-    return "", 204
+    updates = [order.get_progress_update(update_body) for update_body in body["updates"]]
+    with engine.begin() as connection:
+        results = order.apply_progress_updates(connection, updates)
+    order.publish_progress_updates(results, progress_hub, progress_cache)
+    kitchen_view.invalidate()
+
+    return {"results": [result.response_json() for result in results]}
 
 
 @app.route("/order/get/progress/", methods=["POST"])
 def order_get_progress():
-    body = utils.get_body_box(request)
+    body = order.get_progress_validator.validate(utils.get_body_json(request))
     if body is None:
         return error_response(400)
-    body_valid = order.check_get_progress_body(body)
 
-    with Session(engine) as session:
-        order_progress = order.get_progress(session, body.order_id)
-        print(order_progress)
+    with engine.connect() as connection:
+        order_progress = order.get_progress(connection, body["order_id"], progress_cache)
     if order_progress is None:
         return error_response(400)
     return {"order_progress": order_progress}
 
 
+@app.route("/order/subscribe/progress/", methods=["POST"])
+def order_subscribe_progress():
+    """Wait until the progress of an order differs from the progress the client knows (long polling).
+
+    Responds immediately if the progress already differs. Otherwise the request waits until the
+    progress changes or the subscribe timeout is reached. In both cases the current progress is
+    returned and "changed" tells if it differs from the known progress.
+    """
+    body = order.subscribe_progress_validator.validate(utils.get_body_json(request))
+    if body is None:
+        return error_response(400)
+
+    # Subscribe before reading the current progress, so that no change can be missed in between.
+    subscription = progress_hub.subscribe(body["order_id"])
+    if subscription is None:
+        return error_response(503, "too_many_subscriptions")
+    try:
+        with engine.connect() as connection:
+            order_progress = order.get_progress(connection, body["order_id"], progress_cache)
+        if order_progress is None:
+            return error_response(400)
+        if order_progress == body["known_progress"]:
+            new_progress = progress_hub.wait(subscription, defaults.PROGRESS_SUBSCRIBE_TIMEOUT)
+            if new_progress is not None:
+                order_progress = new_progress
+    finally:
+        progress_hub.unsubscribe(subscription)
+
+    return {"order_progress": order_progress, "changed": order_progress != body["known_progress"]}
+
+
+@app.route("/order/kitchen/", methods=["GET"])
+def order_kitchen():
+    """Get the outstanding quantity of each item over all uncompleted orders, grouped by category."""
+    bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
+    if bearer_token is None:
+        return error_response(400)
+    with Session(engine) as session:
+        if not auth.check_access_token(session, bearer_token):
+            return error_response(401, "invalid_access_token")
+
+    return kitchen_view.get_summary()
+
+
+@app.route("/order/dispatch/", methods=["GET"])
+def order_dispatch():
+    """Get uncompleted orders grouped by postal code and city, areas with the most orders first.
+
+    If a postal_code argument is passed only areas with this postal code are returned.
+    """
+    bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
+    if bearer_token is None:
+        return error_response(400)
+    with Session(engine) as session:
+        if not auth.check_access_token(session, bearer_token):
+            return error_response(401, "invalid_access_token")
+
+    return dispatch_index.get_groups(request.args.get("postal_code"))
+
+
 @app.route("/order/get_all/", methods=["GET"])
 def order_get_all():
+    """Get uncompleted orders.
+
+    If a cursor from a previous response is passed as since argument only orders which changed
+    after that response are returned, together with the ids of orders completed in the meantime.
+
+    Orders are returned in pages of at most limit changes. If there are more changes the response
+    contains a next_page_token, which is passed as page_token argument to get the next page.
+    The response is streamed while the orders are read from the database.
+    """
     bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
     if bearer_token is None:
         return error_response(400)
+    limit = order.get_page_limit(request.args.get("limit", type=int))
+    if limit is None:
+        return error_response(400)
+    page_token = request.args.get("page_token")
+    if page_token is not None:
+        page = order.OrderPageToken.decode(page_token)
+        if page is None:
+            return error_response(400)
+    else:
+        since = request.args.get("since", 0, type=int)
+        if since < 0:
+            return error_response(400)
+        page = order.OrderPageToken(since, since > 0)
     with Session(engine) as session:
         if not auth.check_access_token(session, bearer_token):
-            error_response(401, "invalid_access_token")
-        orders = order.get_all_uncompleted_orders(session)
+            return error_response(401, "invalid_access_token")
 
-    orders_json = Box()
-    orders_json.orders = [order.to_json() for order in orders]
-    orders_json.time = arrow.now().int_timestamp
+    orders_json = order.generate_changed_orders_json(engine, page, limit)
+    return Response(stream_with_context(orders_json), mimetype="application/json")
 
-    return orders_json
+
+@app.route("/order/history/", methods=["GET"])
+def order_history():
+    """Get archived orders, the most recently placed orders first.
+
+    Orders are returned in pages of at most limit orders. If there are more orders the response
+    contains next_before, which is passed as before argument to get the next page.
+    """
+    bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
+    if bearer_token is None:
+        return error_response(400)
+    limit = order.get_page_limit(request.args.get("limit", type=int))
+    if limit is None:
+        return error_response(400)
+    before = request.args.get("before", type=int)
+    if before is not None and before < 1:
+        return error_response(400)
+
+    with Session(engine) as session:
+        if not auth.check_access_token(session, bearer_token):
+            return error_response(401, "invalid_access_token")
+        archived_orders = archive.get_archived_orders(session, before, limit + 1)
+        next_before = None
+        if len(archived_orders) > limit:
+            archived_orders = archived_orders[:limit]
+            next_before = archived_orders[-1].order_id
+        orders_json = [archived_order.to_json() for archived_order in archived_orders]
+
+    return {"orders": orders_json, "next_before": next_before}
+
+
+@app.route("/stats/", methods=["GET"])
+def get_stats():
+    """Get hourly order counters of the last hours and sales counters of all items.
+
+    The amount of hours is passed as hours argument and defaults to 24 hours.
+    """
+    bearer_token = auth.parse_bearer_token(request.headers.get("Authorization"))
+    if bearer_token is None:
+        return error_response(400)
+    hours = request.args.get("hours", 24, type=int)
+    if not 1 <= hours <= defaults.STATS_MAX_HOURS:
+        return error_response(400)
+    with Session(engine) as session:
+        if not auth.check_access_token(session, bearer_token):
+            return error_response(401, "invalid_access_token")
+
+    until = arrow.now().int_timestamp
+    with engine.connect() as connection:
+        return stats.get_stats(connection, until - (hours - 1) * defaults.STATS_BUCKET_SIZE, until)
 
 
 @app.route("/auth/login/", methods=["POST"])
@@ -122,14 +405,16 @@ def auth_login():
     auth_info = auth.get_auth_info(request.authorization)
     if auth_info is None:
         return error_response(400)
-    body = utils.get_body_box(request)
+    body = auth.login_validator.validate(utils.get_body_json(request))
     if body is None:
         return error_response(400)
-    if "device_description" not in body:
-        logger.debug('No "device_description" key is set in the auth login request body.')
-        return error_response(400)
     with Session(engine) as session:
-        delivery_user = auth.find_delivery_user(session, auth_info)
+        try:
+            delivery_user = auth.find_delivery_user(session, auth_info, password_verifier)
+        except PasswordVerifierBusy:
+            response, error_code = error_response(503, "login_busy")
+            response.headers["Retry-After"] = str(defaults.LOGIN_RETRY_AFTER)
+            return response, error_code
         if delivery_user is None:
             return error_response(401, "credentials_invalid")
 
@@ -143,9 +428,9 @@ def auth_login():
             return error_response(403, "reached_refresh_token_limit")
 
     new_refresh_token = auth.gen_refresh_token(
-        user_id=delivery_user.user_id, device_description=body.device_description
+        user_id=delivery_user.user_id, device_description=body["device_description"]
     )
-    new_access_token = auth.gen_access_token()
+    new_access_token = auth.gen_access_token(delivery_user.user_id, new_refresh_token)
     token_info = auth.TokenInfo(new_refresh_token, new_access_token)
     store_operation = StoreOperation(
         auth.store_token_info,
@@ -179,6 +464,7 @@ def auth_refresh():
 
         session.refresh(origi_refresh_token)
         session.refresh(origi_description)
+        origi_access_tokens = origi_refresh_token.access_tokens
 
     if origi_refresh_token.valid is False:
         # RFC-6819 5.2.2.3 states refresh token rotation. Following this RFC if a invalid refresh token
@@ -192,7 +478,6 @@ def auth_refresh():
         lock.release()
         return error_response(403, "invalid_refresh_token")
 
-    origi_access_tokens = origi_refresh_token.access_tokens
     if len(origi_access_tokens) > 0:
         if auth.check_expiration_times_valid(origi_access_tokens) is False:
             lock.release()
@@ -202,7 +487,7 @@ def auth_refresh():
         originated_from=origi_refresh_token.refresh_token_id,
         refers_description=origi_description.description_id,
     )
-    new_access_token = auth.gen_access_token()
+    new_access_token = auth.gen_access_token(origi_description.user_id, new_refresh_token)
     token_info = auth.TokenInfo(new_refresh_token, new_access_token)
     store_operation = StoreOperation(
         auth.store_refreshed_token_info,
@@ -217,6 +502,7 @@ def auth_refresh():
 def _kill_event_handler(signum, frame):
     """Set the threading kill event flag to true."""
     kill_event.set()
+    password_verifier.shutdown()
     sys.exit(0)
 
 
@@ -229,6 +515,12 @@ def main():
 
     confirm_required_tables_exist()
 
+    if config.security.signed_access_tokens and auth.get_access_token_signing_key() is None:
+        logger.warning("Signed access tokens are enabled, but no token pepper is set. Not signing them.")
+
+    # Start the worker processes before any thread is started, see PasswordVerifier.start.
+    password_verifier.start()
+
     # Threads should check the kill event periodically to check if the program should exit.
     signal.signal(signal.SIGINT, _kill_event_handler)
 
@@ -237,6 +529,44 @@ def main():
     )
     store_thread.start()
 
+    catalog_thread = threading.Thread(
+        name="refresh_catalog",
+        target=catalog_helper.run_catalog_refresh_thread,
+        args=(catalog_refresher, kill_event),
+    )
+    catalog_thread.start()
+
+    ingest_thread = threading.Thread(
+        name="ingest_orders", target=ingest.run_ingest_thread, args=(order_ingestor, kill_event)
+    )
+    ingest_thread.start()
+
+    archive_thread = threading.Thread(
+        name="archive_orders",
+        target=archive.run_archive_thread,
+        args=(
+            engine,
+            kill_event,
+            config.archive.max_age_hours * 3600,
+            config.archive.batch_size,
+            config.archive.interval_minutes * 60,
+        ),
+    )
+    archive_thread.start()
+
+    sweep_thread = threading.Thread(
+        name="sweep_tokens",
+        target=sweep.run_sweep_thread,
+        args=(
+            engine,
+            kill_event,
+            config.token_sweep.refresh_token_retention_days * 86400,
+            config.token_sweep.batch_size,
+            config.token_sweep.interval_minutes * 60,
+        ),
+    )
+    sweep_thread.start()
+
     if __name__ == "__main__":
         app.run()
 
@@ -0,0 +1,150 @@
+"""Move completed orders out of the order tables.
+
+Delivery queries only need uncompleted and recently completed orders. Older completed orders are moved
+to the archive tables in batches, so that the order tables stay small no matter how many orders were
+placed over time. Archived orders can still be read from the archive tables.
+
+Clients which didn't fetch order changes for longer than the archive age won't see archived orders in
+the completed order ids of the order changes anymore and need to fetch all orders again.
+"""
+
+import threading
+
+from typing import Optional
+
+import arrow
+
+from loguru import logger
+from sqlalchemy import delete, insert, literal, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload, Session
+
+from pizzaapp.app.order import ORDER_IS_OPEN
+from pizzaapp.app.tables import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+# Columns which are copied from the order tables to the archive tables.
+_ORDER_COLUMNS = [
+    "order_id",
+    "first_name",
+    "last_name",
+    "street",
+    "city",
+    "postal_code",
+    "order_progress",
+    "version",
+    "created_time",
+    "completed_time",
+]
+_ORDER_ITEM_COLUMNS = ["order_item_id", "order_id", "item_id", "unit_price", "quantity"]
+
+
+def archive_order_batch(connection: Connection, completed_before: int, batch_size: int) -> int:
+    """Move a batch of orders completed before a certain time to the archive tables.
+
+    The connection needs to be in a transaction, which is committed by the caller.
+
+    :param completed_before: Timestamp before which the orders must have been completed.
+    :param batch_size: Maximum amount of orders to move.
+    :returns: The amount of orders moved.
+    """
+    order_table = Order.__table__
+    order_item_table = OrderItem.__table__
+
+    stmt = (
+        select(order_table.c.order_id)
+        .where(~ORDER_IS_OPEN, order_table.c.completed_time <= completed_before)
+        .order_by(order_table.c.completed_time)
+        .limit(batch_size)
+    )
+    order_ids = connection.execute(stmt).scalars().all()
+    if not order_ids:
+        return 0
+
+    archived_time = arrow.now().int_timestamp
+    orders = select(
+        *[order_table.c[column] for column in _ORDER_COLUMNS], literal(archived_time).label("archived_time")
+    ).where(order_table.c.order_id.in_(order_ids))
+    connection.execute(
+        insert(ArchivedOrder.__table__).from_select(_ORDER_COLUMNS + ["archived_time"], orders)
+    )
+    order_items = select(*[order_item_table.c[column] for column in _ORDER_ITEM_COLUMNS]).where(
+        order_item_table.c.order_id.in_(order_ids)
+    )
+    connection.execute(insert(ArchivedOrderItem.__table__).from_select(_ORDER_ITEM_COLUMNS, order_items))
+
+    connection.execute(delete(order_item_table).where(order_item_table.c.order_id.in_(order_ids)))
+    connection.execute(delete(order_table).where(order_table.c.order_id.in_(order_ids)))
+    return len(order_ids)
+
+
+def archive_orders(
+    engine: Engine, max_age: int, batch_size: int, kill_event: Optional[threading.Event] = None
+) -> int:
+    """Move all orders which were completed longer than max_age seconds ago to the archive tables.
+
+    Each batch is moved in its own transaction, so that other connections can write in between.
+
+    :param max_age: Time in seconds after the completion of an order after which it is archived.
+    :param batch_size: Maximum amount of orders moved in one transaction.
+    :param kill_event: Optional event after which no further batches are moved.
+    :returns: The amount of orders moved.
+    """
+    completed_before = arrow.now().int_timestamp - max_age
+    archived_count = 0
+    while kill_event is None or not kill_event.is_set():
+        with engine.begin() as connection:
+            batch_count = archive_order_batch(connection, completed_before, batch_size)
+        archived_count += batch_count
+        if batch_count < batch_size:
+            break
+
+    if archived_count > 0:
+        logger.info(f"Archived {archived_count} completed orders.")
+    return archived_count
+
+
+def get_archived_orders(session: Session, before: Optional[int], limit: int) -> list[ArchivedOrder]:
+    """Get archived orders, the most recently placed orders first.
+
+    :param before: Only get orders with a lower order id. If None the most recent orders are returned.
+    :param limit: Maximum amount of orders to get.
+    """
+    stmt = (
+        select(ArchivedOrder)
+        .options(selectinload(ArchivedOrder.items))
+        .order_by(ArchivedOrder.order_id.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        stmt = stmt.where(ArchivedOrder.order_id < before)
+    return session.execute(stmt).scalars().all()
+
+
+def run_archive_thread(
+    engine: Engine,
+    kill_event: threading.Event,
+    max_age: int,
+    batch_size: int,
+    refresh_interval: int,
+):
+    """Periodically archive old completed orders.
+
+    :param engine: Engine used to archive the orders.
+    :param kill_event: A event signalizing this thread to terminate.
+    :param max_age: Time in seconds after the completion of an order after which it is archived.
+    :param batch_size: Maximum amount of orders moved in one transaction.
+    :param refresh_interval: Interval in seconds in which to look for orders to archive.
+    """
+    while True:
+        kill_thread = kill_event.wait(refresh_interval)
+        if kill_thread is True:
+            break
+        try:
+            archive_orders(engine, max_age, batch_size, kill_event)
+        except SQLAlchemyError:
+            # The orders stay in the order tables, the next run will try again.
+            logger.exception("Couldn't archive completed orders.")
+
+    thread = threading.current_thread()
+    logger.info(f"Shutting down {thread.name} thread (TID: {thread.native_id}).")
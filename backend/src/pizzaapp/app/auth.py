@@ -6,25 +6,58 @@ Includes functions handling username, password, refresh tokens and access tokens
 from __future__ import annotations
 
 import hashlib
+import hmac
 import random
 import secrets
+import struct
 
 from dataclasses import dataclass
 from loguru import logger
 from threading import Lock
-from typing import Optional
+from typing import Iterator, Optional
 
 import arrow
 
-from passlib.hash import bcrypt
 from sqlalchemy import and_, func, select
 from sqlalchemy.orm import Session
 from werkzeug.datastructures import Authorization as AuthorizationHeader
 
+from pizzaapp.app import config
 from pizzaapp.app import defaults
-from pizzaapp.app import utils
+from pizzaapp.app import schema
+from pizzaapp.app.cache import BoundedCache
+from pizzaapp.app.password import PasswordVerifier
 from pizzaapp.app.tables import AccessToken, DeliveryUser, RefreshToken, RefreshTokenDescription
 
+# Validates the body of a login request. The device description may be null.
+login_validator = schema.Validator(
+    schema.Object(
+        {
+            "device_description": schema.String(
+                max_length=defaults.DEVICE_DESCRIPTION_MAX_LENGTH, nullable=True
+            ),
+        }
+    )
+)
+
+
+# Access tokens which were recently verified. Keyed by a digest of the raw token, keyed with a random
+# key of this process, so that the raw tokens aren't kept in memory.
+_verified_access_tokens = BoundedCache(defaults.ACCESS_TOKEN_CACHE_SIZE)
+_access_token_cache_key = secrets.token_bytes(32)
+
+
+@dataclass
+class VerifiedAccessToken:
+    """Information about a cached verified access token, used to invalidate it."""
+
+    refresh_token_id: int
+    user_id: int
+
+
+# Fields of a signed access token: version, user id, refresh token fingerprint and expiration time.
+_SIGNED_ACCESS_TOKEN_FIELDS = struct.Struct(">BIQI")
+
 
 @dataclass
 class AuthentificationInfo:
@@ -32,14 +65,22 @@ class AuthentificationInfo:
     pw_hash: str
 
 
+def get_token_hash_version() -> int:
+    """Get the version of the scheme with which new tokens are hashed."""
+    if config.security.token_pepper:
+        return defaults.TOKEN_HASH_VERSION_HMAC
+    return defaults.TOKEN_HASH_VERSION_LEGACY
+
+
 @dataclass
 class BasicToken:
     token_hex: str
     token_hash: str
+    hash_version: int
 
-    @classmethod
-    def _hash_token(cls, token_bytes: bytes) -> str:
-        """Hash the token hex with sha256."""
+    @staticmethod
+    def _hash_token_legacy(token_bytes: bytes) -> str:
+        """Hash the token with 5000 chained sha256 rounds."""
 
         token_bytes_holder = None
         for _ in range(5000):
@@ -54,25 +95,179 @@ class BasicToken:
 
         return token_hash
 
+    @staticmethod
+    def _hash_token_hmac(token_bytes: bytes) -> str:
+        """Hash the token with HMAC-SHA256 keyed with the token pepper."""
+        pepper = config.security.token_pepper.encode("utf-8")
+        return hmac.new(pepper, token_bytes, hashlib.sha256).hexdigest()
+
+    @classmethod
+    def _hash_token(cls, token_bytes: bytes, hash_version: int) -> str:
+        """Hash the token with the scheme of a certain version."""
+        if hash_version == defaults.TOKEN_HASH_VERSION_HMAC:
+            return cls._hash_token_hmac(token_bytes)
+        return cls._hash_token_legacy(token_bytes)
+
     @classmethod
-    def from_hex(cls, token_hex: str) -> BasicToken:
+    def from_hex(cls, token_hex: str, hash_version: Optional[int] = None) -> BasicToken:
         """Create a BasicToken instance by providing only the token hex.
 
         The token hash will be automatically generated.
 
+        :param hash_version: Version of the hash scheme. Defaults to the version used for new tokens.
         :returns: BasicToken instance.
         """
+        if hash_version is None:
+            hash_version = get_token_hash_version()
         token = bytes.fromhex(token_hex)
-        token_hash = cls._hash_token(token)
-        return cls(token_hex, token_hash)
+        token_hash = cls._hash_token(token, hash_version)
+        return cls(token_hex, token_hash, hash_version)
 
     @classmethod
     def generate(cls) -> BasicToken:
         token_length = random.choice(defaults.TOKEN_LENGTH)
         token = secrets.token_bytes(int(token_length / 2))
         token_hex = token.hex()
-        token_hash = cls._hash_token(token)
-        return cls(token_hex, token_hash)
+        hash_version = get_token_hash_version()
+        token_hash = cls._hash_token(token, hash_version)
+        return cls(token_hex, token_hash, hash_version)
+
+
+def get_access_token_signing_key() -> Optional[bytes]:
+    """Get the key with which access tokens are signed.
+
+    The key is derived from the token pepper, so it doesn't need to be configured separately.
+
+    :returns: The key, none if access tokens aren't signed.
+    """
+    if not config.security.signed_access_tokens or not config.security.token_pepper:
+        return None
+    pepper = config.security.token_pepper.encode("utf-8")
+    return hmac.new(pepper, b"signed access token", hashlib.sha256).digest()
+
+
+def get_refresh_token_fingerprint(refresh_token_hash: str) -> int:
+    """Get the fingerprint of a refresh token which is included in signed access tokens.
+
+    The fingerprint is derived from the stored hash of the refresh token. It's used instead of the
+    refresh token id, because the id isn't known yet when the access token is issued.
+    """
+    digest = hashlib.blake2b(refresh_token_hash.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+@dataclass
+class SignedAccessToken:
+    """Access token which carries its own information and is verified by its signature."""
+
+    user_id: int
+    refresh_token_fingerprint: int
+    expiration_time: int
+
+    @staticmethod
+    def _sign(key: bytes, fields: bytes) -> bytes:
+        return hmac.new(key, fields, hashlib.sha256).digest()[: defaults.SIGNED_ACCESS_TOKEN_MAC_SIZE]
+
+    def to_hex(self, key: bytes) -> str:
+        """Sign the token and get it as hex."""
+        fields = _SIGNED_ACCESS_TOKEN_FIELDS.pack(
+            defaults.SIGNED_ACCESS_TOKEN_VERSION,
+            self.user_id,
+            self.refresh_token_fingerprint,
+            self.expiration_time,
+        )
+        return (fields + self._sign(key, fields)).hex()
+
+    @classmethod
+    def from_hex(cls, key: bytes, token_hex: str) -> Optional[SignedAccessToken]:
+        """Verify a signed access token and get its information.
+
+        :param token_hex: The token as valid hex.
+        :returns: SignedAccessToken instance, none if the token isn't a signed access token or its
+            signature is invalid. Doesn't check if the token expired or was revoked.
+        """
+        token = bytes.fromhex(token_hex)
+        fields_size = _SIGNED_ACCESS_TOKEN_FIELDS.size
+        if len(token) != fields_size + defaults.SIGNED_ACCESS_TOKEN_MAC_SIZE:
+            return None
+        fields = token[:fields_size]
+        if fields[0] != defaults.SIGNED_ACCESS_TOKEN_VERSION:
+            return None
+        if not hmac.compare_digest(token[fields_size:], cls._sign(key, fields)):
+            return None
+        _, user_id, refresh_token_fingerprint, expiration_time = _SIGNED_ACCESS_TOKEN_FIELDS.unpack(fields)
+        return cls(user_id, refresh_token_fingerprint, expiration_time)
+
+
+class AccessTokenRevocations:
+    """Signed access tokens which were revoked before they expired.
+
+    Signed access tokens are checked without the database, so their revocation must be kept in memory
+    until all revoked tokens expired. Tokens are revoked per refresh token, when the refresh token is
+    rotated or deleted. Access tokens of refresh tokens issued later, for example after the user logged
+    in again, aren't affected. Revocations are dropped once the tokens they revoke expired, which keeps
+    the set small.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Maps refresh token fingerprints to the time they were revoked at. Entries are inserted in the
+        # order of their revocation time, so the oldest ones are at the start.
+        self._refresh_tokens: dict[int, int] = {}
+
+    def revoke_refresh_token(self, refresh_token_fingerprint: int):
+        """Revoke all access tokens issued together with a refresh token."""
+        now = arrow.now().int_timestamp
+        with self._lock:
+            self._refresh_tokens.pop(refresh_token_fingerprint, None)
+            self._refresh_tokens[refresh_token_fingerprint] = now
+            # No access tokens are issued for a revoked refresh token, so the ones it has expire at the
+            # latest ACCESS_TOKEN_VALID_TIME after the revocation.
+            oldest_needed = now - defaults.ACCESS_TOKEN_VALID_TIME
+            while self._refresh_tokens:
+                first_fingerprint = next(iter(self._refresh_tokens))
+                if self._refresh_tokens[first_fingerprint] >= oldest_needed:
+                    break
+                del self._refresh_tokens[first_fingerprint]
+
+    def is_revoked(self, token: SignedAccessToken) -> bool:
+        with self._lock:
+            return token.refresh_token_fingerprint in self._refresh_tokens
+
+
+_revoked_access_tokens = AccessTokenRevocations()
+
+
+# Per token table if tokens hashed with the legacy scheme might still exist. They're replaced by
+# tokens hashed with the current scheme when they're rotated. Once none are left no new ones are
+# created, so they don't need to be looked for anymore.
+_legacy_token_hashes_exist = {AccessToken: True, RefreshToken: True}
+
+
+def _legacy_token_hashes_may_exist(session: Session, table: type) -> bool:
+    """Check if tokens of a table might still be hashed with the legacy scheme."""
+    if get_token_hash_version() == defaults.TOKEN_HASH_VERSION_LEGACY:
+        return False
+    if not _legacy_token_hashes_exist[table]:
+        return False
+    stmt = select(table.hash_version).where(table.hash_version == defaults.TOKEN_HASH_VERSION_LEGACY).limit(1)
+    if session.execute(stmt).first() is None:
+        logger.info(f"No {table.__tablename__} tokens with legacy hashes are left.")
+        _legacy_token_hashes_exist[table] = False
+        return False
+    return True
+
+
+def iter_token_hashes(session: Session, table: type, token_hex: str) -> Iterator[BasicToken]:
+    """Iterate over the hashes a stored token might have, the hash of the current scheme first.
+
+    The legacy hash is only computed if tokens with legacy hashes might still exist.
+
+    :param table: Table of the token, either AccessToken or RefreshToken.
+    """
+    yield BasicToken.from_hex(token_hex)
+    if _legacy_token_hashes_may_exist(session, table):
+        yield BasicToken.from_hex(token_hex, defaults.TOKEN_HASH_VERSION_LEGACY)
 
 
 def gen_refresh_token(
@@ -116,6 +311,7 @@ def gen_refresh_token(
     refresh_token = RefreshToken(
         originated_from=originated_from,
         refresh_token_hash=token.token_hash,
+        hash_version=token.hash_version,
         refresh_token=token.token_hex,
         valid=True,
         issuing_time=arrow.now().int_timestamp,
@@ -124,15 +320,29 @@ def gen_refresh_token(
     return refresh_token
 
 
-def gen_access_token() -> AccessToken:
-    """Generate a new access token object."""
+def gen_access_token(user_id: int, refresh_token: RefreshToken) -> AccessToken:
+    """Generate a new access token object.
+
+    If access tokens are signed the token is a signed access token. It's stored like other access
+    tokens, so that refreshes can check its expiration time and it stays valid if signing is disabled.
+
+    :param user_id: The user id for which the access token is issued.
+    :param refresh_token: The refresh token which is issued together with the access token.
+    """
     now = arrow.now()
     expiration_time = now.shift(seconds=defaults.ACCESS_TOKEN_VALID_TIME).int_timestamp
-    token = BasicToken.generate()
+    signing_key = get_access_token_signing_key()
+    if signing_key is None:
+        token = BasicToken.generate()
+    else:
+        refresh_token_fingerprint = get_refresh_token_fingerprint(refresh_token.refresh_token_hash)
+        signed_token = SignedAccessToken(user_id, refresh_token_fingerprint, expiration_time)
+        token = BasicToken.from_hex(signed_token.to_hex(signing_key))
     access_token = AccessToken(
         # Refresh token id can't be known at this point because no refresh token was inserted yet.
         refresh_token_id=None,
         access_token_hash=token.token_hash,
+        hash_version=token.hash_version,
         access_token=token.token_hex,
         expiration_time=expiration_time,
     )
@@ -183,11 +393,16 @@ def get_auth_info(authorization: AuthorizationHeader) -> Optional[Authentificati
     return auth_info
 
 
-def find_delivery_user(session: Session, auth_info: AuthentificationInfo) -> Optional[DeliveryUser]:
+def find_delivery_user(
+    session: Session, auth_info: AuthentificationInfo, password_verifier: PasswordVerifier
+) -> Optional[DeliveryUser]:
     """Try to find a delivery user for which the provided auth into is valid.
 
     This will check the username and the password hash which is provided in auth_info.
 
+    :param password_verifier: Verifies the password on a worker process.
+    :raises PasswordVerifierBusy: If the password couldn't be verified because too many
+        verifications are pending.
     :returns: The DeliveryUser if the auth info is valid, none if
         the auth info is invalid (i.e. wrong username or password hash).
     """
@@ -197,7 +412,7 @@ def find_delivery_user(session: Session, auth_info: AuthentificationInfo) -> Opt
         logger.info(f"No user in database for username {auth_info.username}.")
         return None
 
-    pw_correct = bcrypt.verify(auth_info.pw_hash, delivery_user.pw_hash)
+    pw_correct = password_verifier.verify(auth_info.pw_hash, delivery_user.pw_hash)
     if not pw_correct:
         logger.info(f"User {auth_info.username} tried to login, but provided wrong credentials.")
         return None
@@ -273,10 +488,14 @@ def get_refresh_token(session: Session, token_hex: str) -> Optional[RefreshToken
         associated refresh token record.
     :returns: Refresh token ORM object if an entry was found, none if no entry was found.
     """
-    basic_token = BasicToken.from_hex(token_hex)
-    refresh_token = utils.one_or_none(
-        select(RefreshToken).filter(RefreshToken.refresh_token_hash == basic_token.token_hash).all()
-    )
+    for basic_token in iter_token_hashes(session, RefreshToken, token_hex):
+        stmt = select(RefreshToken).where(
+            RefreshToken.refresh_token_hash == basic_token.token_hash,
+            RefreshToken.hash_version == basic_token.hash_version,
+        )
+        refresh_token = session.execute(stmt).scalar_one_or_none()
+        if refresh_token is not None:
+            break
     if refresh_token is None:
         logger.info(f"Didn't find refresh token in database: {token_hex}.")
         return None
@@ -314,23 +533,71 @@ def check_expiration_times_valid(access_tokens: list[AccessToken]) -> bool:
     return True
 
 
+def _get_access_token_cache_key(access_token: str) -> bytes:
+    """Get the key of an access token in the verified access token cache."""
+    return hashlib.blake2b(bytes.fromhex(access_token), key=_access_token_cache_key, digest_size=16).digest()
+
+
 def check_access_token(session: Session, access_token: str) -> bool:
     """Check if the parsed access token is valid and the request is thus authorized.
 
+    Signed access tokens are checked by their signature and the revocations of this process.
+    Other valid access tokens are cached until they expire, but at most for ACCESS_TOKEN_CACHE_TIME.
+    Requests with a cached access token neither need to hash the token nor query the database.
+
     :param access_token: Access token as valid hex.
     """
-    basic_token = BasicToken.from_hex(access_token)
-    access_token = utils.one_or_none(
-        session.query(AccessToken).filter(AccessToken.access_token_hash == basic_token.token_hash).all()
-    )
-    if not access_token:
+    signing_key = get_access_token_signing_key()
+    if signing_key is not None:
+        signed_token = SignedAccessToken.from_hex(signing_key, access_token)
+        if signed_token is not None:
+            if signed_token.expiration_time < arrow.now().int_timestamp:
+                return False
+            return not _revoked_access_tokens.is_revoked(signed_token)
+
+    cache_key = _get_access_token_cache_key(access_token)
+    if _verified_access_tokens.get(cache_key) is not None:
+        return True
+
+    invalidations = _verified_access_tokens.invalidations
+    for basic_token in iter_token_hashes(session, AccessToken, access_token):
+        stmt = (
+            select(AccessToken, RefreshTokenDescription.user_id)
+            .join(AccessToken.refresh_token)
+            .join(RefreshToken.description)
+            .where(
+                AccessToken.access_token_hash == basic_token.token_hash,
+                AccessToken.hash_version == basic_token.hash_version,
+            )
+        )
+        row = session.execute(stmt).one_or_none()
+        if row is not None:
+            break
+    else:
         return False
-    now = arrow.now()
-    if access_token.expiration_time < now.int_timestamp:
+    access_token, user_id = row
+    now = arrow.now().int_timestamp
+    if access_token.expiration_time < now:
         return False
+
+    # The cache time limits how long other processes still accept an access token which was revoked.
+    expires_at = min(access_token.expiration_time, now + defaults.ACCESS_TOKEN_CACHE_TIME)
+    verified_token = VerifiedAccessToken(access_token.refresh_token_id, user_id)
+    _verified_access_tokens.set(cache_key, verified_token, expires_at, invalidations)
     return True
 
 
+def forget_verified_access_tokens(user_id: Optional[int] = None, refresh_token_id: Optional[int] = None):
+    """Remove verified access tokens of a user or a refresh token from the cache.
+
+    The next request with such an access token is checked against the database again.
+    """
+    _verified_access_tokens.pop_where(
+        lambda verified_token: verified_token.user_id == user_id
+        or verified_token.refresh_token_id == refresh_token_id
+    )
+
+
 def add_new_tokens(session: Session, token_info: TokenInfo):
     """Add new refresh and access tokens to the session.
 
@@ -352,10 +619,18 @@ def store_token_info(session: Session, lock: Lock, token_info: TokenInfo):
     lock.release()
 
 
-def expire_user_access(session: Session, description: RefreshTokenDescription):
+def expire_user_access(session: Session, user_id: int):
     """Delete all refresh and access tokens for a delivery user."""
 
-    stmt = select(RefreshTokenDescription).where(RefreshTokenDescription.user_id == description.user_id)
+    # Signed access tokens of the deleted refresh tokens need to be revoked in memory.
+    stmt = (
+        select(RefreshToken.refresh_token_hash)
+        .join(RefreshToken.description)
+        .where(RefreshTokenDescription.user_id == user_id)
+    )
+    refresh_token_hashes = session.execute(stmt).scalars().all()
+
+    stmt = select(RefreshTokenDescription).where(RefreshTokenDescription.user_id == user_id)
     descriptions = session.execute(stmt).scalars().all()
     for des in descriptions:
         # If RefreshTokenDescription gets deleted all refresh tokens which refer to it will
@@ -363,6 +638,9 @@ def expire_user_access(session: Session, description: RefreshTokenDescription):
         # refresh token gets deleted all its associated access tokens also get deleted.
         session.delete(des)
     session.commit()
+    forget_verified_access_tokens(user_id=user_id)
+    for refresh_token_hash in refresh_token_hashes:
+        _revoked_access_tokens.revoke_refresh_token(get_refresh_token_fingerprint(refresh_token_hash))
 
 
 def store_refreshed_token_info(
@@ -380,8 +658,12 @@ def store_refreshed_token_info(
 
     session.add(origi_refresh_token)
     origi_refresh_token.valid = False
+    refresh_token_id = origi_refresh_token.refresh_token_id
+    refresh_token_fingerprint = get_refresh_token_fingerprint(origi_refresh_token.refresh_token_hash)
 
     add_new_tokens(session, token_info)
 
     session.commit()
+    forget_verified_access_tokens(refresh_token_id=refresh_token_id)
+    _revoked_access_tokens.revoke_refresh_token(refresh_token_fingerprint)
     lock.release()
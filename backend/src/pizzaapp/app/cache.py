@@ -0,0 +1,88 @@
+"""In-memory caches shared between request threads."""
+
+import time
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+
+class BoundedCache:
+    """Thread-safe cache holding at most max_size entries.
+
+    If the cache is full the least recently used entry is evicted. Entries can optionally expire
+    at a certain time.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # Counts how often entries were removed with pop_where. See set.
+        self.invalidations = 0
+        self._entries = OrderedDict()  # Maps keys to tuples of value and expiration time.
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get the value for a key, none if the key isn't cached or the entry expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        expires_at: Optional[float] = None,
+        expected_invalidations: Optional[int] = None,
+    ):
+        """Set the value for a key, replacing a cached value.
+
+        :param expires_at: Optional timestamp at which the entry expires.
+        :param expected_invalidations: If set the value is only cached if no entries were removed with
+            pop_where since invalidations had this value. Read invalidations before reading a value
+            from the database, so that an invalidation in the meantime can't be undone.
+        """
+        with self._lock:
+            if expected_invalidations is not None and expected_invalidations != self.invalidations:
+                return
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def set_versioned(self, key: Hashable, version: int, value: Any):
+        """Set the value for a key unless a value of the same or a newer version is cached.
+
+        Use this if values can be set in a different order than they were created, for example by
+        concurrent requests. All values of the key must be set with this method. Get returns tuples of
+        the version and the value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0][0] >= version:
+                return
+            self._entries[key] = ((version, value), None)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def pop(self, key: Hashable):
+        """Remove a key from the cache. Does nothing if the key isn't cached."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_where(self, predicate: Callable[[Any], bool]):
+        """Remove all entries whose value matches the predicate."""
+        with self._lock:
+            self.invalidations += 1
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
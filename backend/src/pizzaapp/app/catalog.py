@@ -1,98 +1,478 @@
 """Store information about the catalog and provide helper functions for it."""
 
-from box import Box
+import hashlib
+import json
+import math
+import re
+import threading
+
+from bisect import bisect_left
+from decimal import Decimal
+from enum import IntFlag
+from typing import Iterable, NamedTuple, Optional, Union
+
 from loguru import logger
+from sqlalchemy import Integer, func, select, type_coerce
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from pizzaapp.app import compression
+from pizzaapp.app import defaults
+from pizzaapp.app.tables import Category, CatalogChange, CatalogVersion, Item, ItemPrice, ItemSpeciality
+
+# Primary key of the single row in the catalog version table.
+CATALOG_VERSION_ID = 1
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+# Query terms up to this length are looked up in precomputed prefix bitsets.
+_SHORT_PREFIX_LENGTH = 2
+
+
+class Speciality(IntFlag):
+    """Flags for the special traits of an item. Items store their specialities as a bitmask."""
+
+    VEGETARIAN = 1
+    VEGAN = 2
+    SPICY = 4
+
+
+class CatalogItem(NamedTuple):
+    """An immutable record holding information about a product of the catalog."""
+
+    item_id: int
+    category_id: int
+    name: str
+    image_name: str
+    ingredient_description: str
+    prices: tuple[int, ...]  # Prices in cents.
+    speciality: int  # Bitmask of Speciality flags.
+
+
+class CatalogCategory(NamedTuple):
+    """An immutable record holding a category and all of its items."""
+
+    category_id: int
+    name: str
+    items: tuple[CatalogItem, ...]
+
+
+def price_to_cents(price: Union[int, float, Decimal]) -> int:
+    """Convert a price to integer cents, rounding to the nearest cent."""
+    return int(round(Decimal(str(price)) * 100))
+
+
+def item_to_json(item: CatalogItem) -> dict:
+    """Convert a catalog item to its json representation."""
+    return {
+        "id": item.item_id,
+        "name": item.name,
+        "image_name": item.image_name,
+        "ingredient_description": item.ingredient_description,
+        "prices": [price / 100 for price in item.prices],
+        "speciality": {
+            "vegetarian": bool(item.speciality & Speciality.VEGETARIAN),
+            "vegan": bool(item.speciality & Speciality.VEGAN),
+            "spicy": bool(item.speciality & Speciality.SPICY),
+        },
+    }
+
+
+def get_catalog_version(session: Session) -> int:
+    """Get the current catalog version. Returns 0 if no version was stored yet."""
+    stmt = select(CatalogVersion.version).where(CatalogVersion.version_id == CATALOG_VERSION_ID)
+    version = session.execute(stmt).scalar_one_or_none()
+    if version is None:
+        return 0
+    return version
+
+
+def bump_catalog_version(session: Session) -> int:
+    """Increment the catalog version. Call this whenever catalog data is changed.
+
+    The change is added to the session, but not committed.
 
-from pizzaapp.app.tables import Category, Item
+    :returns: The new catalog version.
+    """
+    catalog_version = session.get(CatalogVersion, CATALOG_VERSION_ID)
+    if catalog_version is None:
+        catalog_version = CatalogVersion(version_id=CATALOG_VERSION_ID, version=0)
+        session.add(catalog_version)
+    catalog_version.version += 1
+    return catalog_version.version
+
+
+def record_catalog_changes(session: Session, version: int, item_ids: Iterable[int]):
+    """Record in the catalog change log that items changed in a catalog version.
+
+    An item counts as changed if it or one of its prices or its speciality was added, changed or removed.
+    Changes which are already recorded are ignored. The change is executed in the session, but not committed.
+    """
+    rows = [{"version": version, "item_id": item_id} for item_id in set(item_ids)]
+    if not rows:
+        return
+    stmt = sqlite_insert(CatalogChange).on_conflict_do_nothing()
+    session.execute(stmt, rows)
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lower case word tokens used for searching the catalog."""
+    return _TOKEN_PATTERN.findall(text.casefold())
+
+
+class CatalogSearchIndex:
+    """Inverted index to search catalog items by text and to filter them by specialities.
+
+    Each item gets a position. Sets of items are stored as bitsets (python integers) in which
+    the bit at an items position is set if the item is contained in the set. The index maps each
+    token of the item names and ingredient descriptions to the bitset of items containing the token.
+    Combining the bitsets of multiple query terms and speciality filters is a cheap integer operation.
+    """
+
+    def __init__(self, categories: tuple[CatalogCategory, ...]):
+        self._items = tuple(item for category in categories for item in category.items)
+        self._all_items = (1 << len(self._items)) - 1
+
+        token_bitsets = {}
+        speciality_bitsets = {flag: 0 for flag in Speciality}
+        for position, item in enumerate(self._items):
+            item_bit = 1 << position
+            item_text = f"{item.name} {item.ingredient_description or ''}"
+            for token in set(tokenize(item_text)):
+                token_bitsets[token] = token_bitsets.get(token, 0) | item_bit
+            for flag in Speciality:
+                if item.speciality & flag:
+                    speciality_bitsets[flag] |= item_bit
+
+        # Short prefixes match many tokens. Their bitsets are combined once here instead of on each search.
+        prefix_bitsets = {}
+        for token, bitset in token_bitsets.items():
+            for length in range(1, _SHORT_PREFIX_LENGTH + 1):
+                prefix = token[:length]
+                prefix_bitsets[prefix] = prefix_bitsets.get(prefix, 0) | bitset
+
+        self._token_bitsets = token_bitsets
+        self._prefix_bitsets = prefix_bitsets
+        # Sorted tokens allow finding all tokens starting with a query term using binary search.
+        self._vocabulary = sorted(token_bitsets)
+        self._speciality_bitsets = speciality_bitsets
+
+    def _term_bitset(self, term: str) -> int:
+        """Get the bitset of all items which contain a token starting with the term."""
+        if len(term) <= _SHORT_PREFIX_LENGTH:
+            return self._prefix_bitsets.get(term, 0)
+
+        bitset = 0
+        position = bisect_left(self._vocabulary, term)
+        while position < len(self._vocabulary):
+            token = self._vocabulary[position]
+            if not token.startswith(term):
+                break
+            bitset |= self._token_bitsets[token]
+            position += 1
+        return bitset
+
+    def search(self, query: str, specialities: Speciality, limit: int) -> list[CatalogItem]:
+        """Search for items matching the query which have all of the specialities.
+
+        :param query: Text query. Every term of the query needs to be the beginning of a word in the
+            name or ingredient description of an item. An empty query matches all items.
+        :param specialities: Speciality flags an item needs to have.
+        :param limit: Maximum amount of items to return.
+        :returns: The matching items in catalog order.
+        """
+        matches = self._all_items
+        for term in tokenize(query):
+            matches &= self._term_bitset(term)
+            if matches == 0:
+                return []
+        for flag in Speciality:
+            if specialities & flag:
+                matches &= self._speciality_bitsets[flag]
+
+        items = []
+        while matches and len(items) < limit:
+            lowest_bit = matches & -matches
+            items.append(self._items[lowest_bit.bit_length() - 1])
+            matches ^= lowest_bit
+        return items
 
 
 class Catalog:
-    """Catalog holds all Category objects and contains multiple helper functions.
+    """Catalog holds all categories and items of the catalog and contains multiple helper functions.
+
+    The catalog data is materialized into immutable CatalogCategory and CatalogItem records. Items
+    of a category can be accessed like catalog.categories[index].items.
+
+    The JSON representation of the catalog is encoded to bytes once when the catalog is loaded.
+    The etag is the hash of these bytes and thus changes whenever the catalog content changes.
+    The bytes are also compressed once for each supported content encoding.
 
-    Through the Category sub-category-objects can be accessed like
-    Category.items or Category.items[index].speciality.
+    Items are additionally indexed by their item id in item_index to allow fast lookups
+    when validating orders. The search_index allows searching items by text and speciality.
+
+    A catalog is never modified after it was loaded. If the catalog data changes a new catalog
+    object is loaded (see CatalogRefresher). The catalog change log is loaded together with the
+    catalog data to answer which items changed since an older catalog version.
     """
 
     def __init__(self, engine: Engine):
         with Session(engine) as session:
+            # The version is read before the catalog data. If the data changes in between, the
+            # catalog holds newer data than its version indicates and is simply reloaded again.
+            self.version = get_catalog_version(session)
             self.categories = self._load_catalog(session)
+            self.item_changes = self._load_item_changes(session)
+        self.item_index = self._build_item_index()
+        self.search_index = CatalogSearchIndex(self.categories)
         self._parsed_json = None
+        self.encoded_json = self._encode_json()
+        self.etag = hashlib.sha256(self.encoded_json).hexdigest()
+        self.compressed_json = {
+            encoding: compression.compress(self.encoded_json, encoding) for encoding in compression.ENCODINGS
+        }
 
-    def _load_catalog(self, session: Session) -> list[Category]:
+    def _load_catalog(self, session: Session) -> tuple[CatalogCategory, ...]:
         """Load the catalog.
 
-        The catalog is loaded by quering all categories, items, prices and specialities.
+        The catalog is loaded by quering all categories, items, prices and specialities as plain rows.
+        No ORM objects are kept after loading.
 
-        :returns: A list of all categories. The other catalog objects can be accessed using the appropriate
-            attributes on a category.
+        :returns: A tuple of all categories. Items can be accessed through the items attribute of a category.
         """
-        categories = (
-            session.query(Category)
-            # Applying selectinload two times will still only load the items once.
-            .options(selectinload(Category.items).selectinload(Item.prices))
-            .options(selectinload(Category.items).selectinload(Item.speciality))
-            .all()
+        # Price values are stored as integers with a scale of two (see price_type in tables.py). Reading
+        # them without the SQLiteDecimal type conversion directly gives the price in cents.
+        price_cents = type_coerce(ItemPrice.price, Integer).label("price_cents")
+        price_stmt = select(ItemPrice.item_id, price_cents).order_by(ItemPrice.item_id, ItemPrice.price_id)
+        prices = {}
+        for row in session.execute(price_stmt):
+            prices.setdefault(row.item_id, []).append(row.price_cents)
+
+        speciality_stmt = select(
+            ItemSpeciality.item_id, ItemSpeciality.vegetarian, ItemSpeciality.vegan, ItemSpeciality.spicy
+        )
+        specialities = {}
+        for row in session.execute(speciality_stmt):
+            speciality = Speciality(0)
+            if row.vegetarian:
+                speciality |= Speciality.VEGETARIAN
+            if row.vegan:
+                speciality |= Speciality.VEGAN
+            if row.spicy:
+                speciality |= Speciality.SPICY
+            specialities[row.item_id] = int(speciality)
+
+        item_stmt = select(
+            Item.item_id, Item.category_id, Item.name, Item.image_name, Item.ingredient_description
+        ).order_by(Item.item_id)
+        category_items = {}
+        for row in session.execute(item_stmt):
+            item = CatalogItem(
+                item_id=row.item_id,
+                category_id=row.category_id,
+                name=row.name,
+                image_name=row.image_name,
+                ingredient_description=row.ingredient_description,
+                prices=tuple(prices.get(row.item_id, ())),
+                # A speciality for an item is optional. Items without speciality have no flags set.
+                speciality=specialities.get(row.item_id, 0),
+            )
+            category_items.setdefault(row.category_id, []).append(item)
+
+        category_stmt = select(Category.category_id, Category.name).order_by(Category.category_id)
+        categories = tuple(
+            CatalogCategory(row.category_id, row.name, tuple(category_items.get(row.category_id, ())))
+            for row in session.execute(category_stmt)
         )
         return categories
 
+    def _load_item_changes(self, session: Session) -> dict[int, int]:
+        """Load the catalog change log.
+
+        :returns: A dictionary mapping item ids to the latest catalog version in which they changed.
+        """
+        stmt = (
+            select(CatalogChange.item_id, func.max(CatalogChange.version))
+            .where(CatalogChange.version <= self.version)
+            .group_by(CatalogChange.item_id)
+        )
+        return dict(session.execute(stmt).all())
+
+    def _build_item_index(self) -> dict[int, CatalogItem]:
+        """Build an index mapping each item id to its item."""
+        item_index = {}
+        for category in self.categories:
+            for item in category.items:
+                item_index[item.item_id] = item
+        return item_index
+
     def to_json(self) -> dict:
         """Convert the catalog to a json representation."""
         if self._parsed_json is not None:
             return self._parsed_json
 
-        parsed_data = Box()
-        parsed_data.categories = {}
-
+        parsed_data = {"categories": {}}
         for category in self.categories:
-            parsed_category = Box()
-            parsed_category.category_id = category.category_id
-            parsed_category.all_items = []
-
-            for item in category.items:
-                parsed_item = Box()
-                parsed_item.id = item.item_id
-                parsed_item.name = item.name
-                parsed_item.image_name = item.image_name
-                parsed_item.ingredient_description = item.ingredient_description
-                parsed_item.prices = [row.price for row in item.prices]
-
-                # A speciality for an item is optional. If no speciality exists a
-                # default speciality will be used - to have a consistent JSON structure.
-                default_speciality = Box(vegetarian=False, vegan=False, spicy=False)
-                parsed_item.speciality = default_speciality
-                if item.speciality is not None:
-                    parsed_item.speciality.vegetarian = item.speciality.vegetarian
-                    parsed_item.speciality.vegan = item.speciality.vegan
-                    parsed_item.speciality.spicy = item.speciality.spicy
-
-                parsed_category.all_items.append(parsed_item)
-
+            parsed_category = {
+                "category_id": category.category_id,
+                "all_items": [item_to_json(item) for item in category.items],
+            }
             category_name = category.name.lower()
-            parsed_data.categories[category_name] = parsed_category
+            parsed_data["categories"][category_name] = parsed_category
 
-        self._parsed_json = parsed_data.to_dict()
+        self._parsed_json = parsed_data
         return self._parsed_json
 
+    def changes_to_json(self, since: int) -> dict:
+        """Get a json representation of all items which changed since a catalog version.
+
+        Changed items are items which were added or changed. Removed items are only listed by their id.
+        If the version is unknown to this catalog (e.g. it is newer than the current version) all items
+        are listed as changed and "full" is set to true. Clients then need to replace their whole catalog.
+        """
+        full = since <= 0 or since > self.version
+        category_names = {category.category_id: category.name.lower() for category in self.categories}
 
-def items_valid(catalog: Catalog, items: list[Item]) -> bool:
-    """Check if the parsed items can be created based on the catalog.
+        changed = []
+        removed = []
+        if full:
+            changed_items = list(self.item_index.values())
+        else:
+            changed_items = []
+            for item_id, version in self.item_changes.items():
+                if version <= since:
+                    continue
+                item = self.item_index.get(item_id)
+                if item is None:
+                    removed.append(item_id)
+                else:
+                    changed_items.append(item)
 
-    For example check if the item ids of the parsed items exist in the catalog.
+        for item in changed_items:
+            item_json = item_to_json(item)
+            item_json["category_id"] = item.category_id
+            item_json["category"] = category_names.get(item.category_id)
+            changed.append(item_json)
 
-    :returns: True if the parsed items are valid, false if not. Will also return false if there
-        are no items in the list.
+        return {"version": self.version, "since": since, "full": full, "changed": changed, "removed": removed}
+
+    def _encode_json(self) -> bytes:
+        """Encode the json representation of the catalog to UTF-8 bytes ready to be sent."""
+        catalog_json = self.to_json()
+        encoded_json = json.dumps(catalog_json, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return encoded_json
+
+
+class CatalogRefresher:
+    """Hold the current catalog and replace it when the catalog version in the database changes.
+
+    Requests should read the catalog attribute once and use this catalog for the whole request.
+    A reload builds a completely new catalog and then swaps the reference, so a request
+    always keeps a consistent catalog, even if a reload happens while the request is handled.
     """
-    if not len(items) >= 1:
-        return False
-
-    category_item_ids = []
-    for category in catalog.categories:
-        for item in category.items:
-            category_item_ids.append(item.item_id)
-    for item in items:
-        if item.item_id not in category_item_ids:
-            logger.info(f"Item id {item.item_id} not found in catalog.")
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.catalog = Catalog(engine)
+
+    def refresh(self) -> bool:
+        """Reload the catalog if its version changed.
+
+        :returns: True if a new catalog was loaded, false if the catalog is up to date.
+        """
+        with Session(self.engine) as session:
+            version = get_catalog_version(session)
+        if version == self.catalog.version:
             return False
-    return True
+
+        new_catalog = Catalog(self.engine)
+        self._record_item_differences(self.catalog, new_catalog)
+        self.catalog = new_catalog
+        logger.info(f"Reloaded catalog with version {new_catalog.version}.")
+        return True
+
+    def _record_item_differences(self, old_catalog: Catalog, new_catalog: Catalog):
+        """Add items which differ between two catalogs to the change log of the new catalog.
+
+        The catalog is only reloaded when the catalog version changes, so catalog data changed without
+        the base data tool must bump the version (see bump_catalog_version) to be noticed at all. If such
+        a change bumped the version but didn't record its item changes, the change log would be
+        incomplete. Those changes are recorded here.
+        """
+        old_items = old_catalog.item_index
+        new_items = new_catalog.item_index
+        different_ids = [
+            item_id
+            for item_id in old_items.keys() | new_items.keys()
+            if old_items.get(item_id) != new_items.get(item_id)
+        ]
+        unrecorded_ids = [
+            item_id
+            for item_id in different_ids
+            if new_catalog.item_changes.get(item_id, 0) <= old_catalog.version
+        ]
+        if not unrecorded_ids:
+            return
+
+        with Session(self.engine) as session:
+            record_catalog_changes(session, new_catalog.version, unrecorded_ids)
+            session.commit()
+        for item_id in unrecorded_ids:
+            new_catalog.item_changes[item_id] = new_catalog.version
+        logger.info(
+            f"Recorded {len(unrecorded_ids)} unlogged item changes for catalog version {new_catalog.version}."
+        )
+
+
+def run_catalog_refresh_thread(
+    refresher: CatalogRefresher,
+    kill_event: threading.Event,
+    refresh_interval=defaults.CATALOG_REFRESH_INTERVAL,
+):
+    """Periodically check if the catalog changed and reload it if so.
+
+    :param refresher: The catalog refresher holding the catalog to keep up to date.
+    :param kill_event: A event signalizing this thread to terminate.
+    :param refresh_interval: Optional interval in which to check the catalog version.
+    """
+    while True:
+        kill_thread = kill_event.wait(refresh_interval)
+        if kill_thread is True:
+            break
+        try:
+            refresher.refresh()
+        except SQLAlchemyError:
+            # Keep serving the current catalog, the next check will try again.
+            logger.exception("Couldn't refresh the catalog.")
+
+    thread = threading.current_thread()
+    logger.info(f"Shutting down {thread.name} thread (TID: {thread.native_id}).")
+
+
+def get_item_price(catalog: Catalog, item_id: int, price: Union[int, float]) -> Optional[Decimal]:
+    """Get the catalog price of an item which matches the price sent by a client.
+
+    Clients send the price of the size they selected. The price is only accepted if the item
+    has a price row with exactly this price (compared in cents).
+
+    :returns: The price as decimal if the item exists and has the price, none if not.
+    """
+    item = catalog.item_index.get(item_id)
+    if item is None:
+        logger.info(f"Item id {item_id} not found in catalog.")
+        return None
+
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        logger.info(f"Price {price!r} for item id {item_id} is not a number.")
+        return None
+    # JSON bodies may contain NaN and Infinity, which can't be converted to cents.
+    if not math.isfinite(price):
+        logger.info(f"Price {price} for item id {item_id} is not a finite number.")
+        return None
+    price_cents = price_to_cents(price)
+    if price_cents not in item.prices:
+        logger.info(f"Price {price} is not a valid price for item id {item_id}.")
+        return None
+
+    return Decimal(price_cents) / 100
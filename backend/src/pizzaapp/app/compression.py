@@ -0,0 +1,84 @@
+"""Compress response bodies.
+
+Bodies are compressed with gzip or deflate if the client accepts one of these encodings
+and the body is large enough for compression to be worth it.
+"""
+
+import gzip
+import zlib
+
+from typing import Iterable, Iterator, Optional, Union
+
+from flask import Request, Response
+
+from pizzaapp.app import defaults
+
+# Supported content encodings, in order of preference.
+ENCODINGS = ("gzip", "deflate")
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data with one of the supported content encodings."""
+    if encoding == "gzip":
+        # A fixed mtime makes the output only depend on the data.
+        return gzip.compress(data, compresslevel=defaults.COMPRESSION_LEVEL, mtime=0)
+    if encoding == "deflate":
+        return zlib.compress(data, defaults.COMPRESSION_LEVEL)
+    raise ValueError(f"Unsupported content encoding: {encoding}.")
+
+
+def choose_encoding(request: Request) -> Optional[str]:
+    """Choose the content encoding for the response to a request based on its Accept-Encoding header.
+
+    :returns: The encoding to use, none if the client doesn't accept any supported encoding.
+    """
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def _compress_stream(chunks: Iterable[Union[bytes, str]], encoding: str) -> Iterator[bytes]:
+    """Compress the chunks of a streamed response body one after another.
+
+    Each chunk is flushed, so that the client can decompress it as soon as it arrives. Otherwise
+    the compressor would hold back small chunks until the end of the stream.
+    """
+    # wbits 31 produces the gzip format, 15 the zlib format which is used for the deflate encoding.
+    wbits = 31 if encoding == "gzip" else 15
+    compressor = zlib.compressobj(defaults.COMPRESSION_LEVEL, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def compress_response(request: Request, response: Response) -> Response:
+    """Compress the body of a response if the client accepts it and the body is large enough.
+
+    Streamed responses are compressed while they are streamed, regardless of their size.
+    Responses which already have a content encoding are left untouched.
+    """
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if response.direct_passthrough:
+        return response
+    if "Content-Encoding" in response.headers:
+        return response
+
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    data = response.get_data()
+    if len(data) < defaults.COMPRESSION_MIN_SIZE:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -4,6 +4,7 @@ Here is where the config file gets read and translated.
 The logger is also configured at this place.
 """
 
+import secrets
 import sys
 
 from configparser import ConfigParser
@@ -12,7 +13,7 @@ from pathlib import Path
 from box import Box
 from loguru import logger
 
-from pizzaapp.app.exceptions import ConfigValueNotBool
+from pizzaapp.app.exceptions import ConfigValueNotBool, ConfigValueNotInt
 from pizzaapp.app.defaults import DEFAULT_CONFIG
 
 
@@ -25,8 +26,10 @@ def _create_config(path: Path):
     """
     print(f"Creating config as it doesn't exist: {path.as_posix()}.")
     path.parent.mkdir(parents=True, exist_ok=True)
+    # Each installation gets its own token pepper.
+    config_content = DEFAULT_CONFIG.replace("token_pepper =", f"token_pepper = {secrets.token_hex(32)}", 1)
     with path.open("w") as fp:
-        fp.write(DEFAULT_CONFIG)
+        fp.write(config_content)
 
 
 def _translate_to_bool(key: str, value: str, config_path: str) -> bool:
@@ -42,10 +45,19 @@ def _translate_to_bool(key: str, value: str, config_path: str) -> bool:
     raise ConfigValueNotBool(key, value, config_path)
 
 
+def _translate_to_int(key: str, value: str, config_path: str) -> int:
+    """Convert a config value to a python integer."""
+    try:
+        return int(value)
+    except ValueError as error:
+        raise ConfigValueNotInt(key, value, config_path) from error
+
+
 def read_config() -> Box:
     """Read the PizzaApp configuration file.
 
     If the config file doesn't exist it will be created and filled with a default configuration.
+    Values missing in an existing config file fall back to the values of the default configuration.
     """
     find_config_paths = (
         Path("~", ".config", "pizzaapp", "config.ini").expanduser(),
@@ -59,6 +71,7 @@ def read_config() -> Box:
             break
 
     config_parsed = ConfigParser()
+    config_parsed.read_string(DEFAULT_CONFIG)
     if config_path is None:
         new_config_path = find_config_paths[0]
         _create_config(new_config_path)
@@ -73,6 +86,19 @@ def read_config() -> Box:
     config.pizzaapp.debug = _translate_to_bool("debug", config.pizzaapp.debug, config_path.as_posix())
     config.paths.database = Path(config.paths.database).expanduser()
     config.paths.log = Path(config.paths.log).expanduser()
+    config.orders.batch_size = _translate_to_int(
+        "batch_size", config.orders.batch_size, config_path.as_posix()
+    )
+    config.orders.batch_window_ms = _translate_to_int(
+        "batch_window_ms", config.orders.batch_window_ms, config_path.as_posix()
+    )
+    config.security.signed_access_tokens = _translate_to_bool(
+        "signed_access_tokens", config.security.signed_access_tokens, config_path.as_posix()
+    )
+    for key in ("max_age_hours", "interval_minutes", "batch_size"):
+        config.archive[key] = _translate_to_int(key, config.archive[key], config_path.as_posix())
+    for key in ("interval_minutes", "batch_size", "refresh_token_retention_days"):
+        config.token_sweep[key] = _translate_to_int(key, config.token_sweep[key], config_path.as_posix())
 
     return config
 
@@ -7,6 +7,38 @@ debug = no
 [paths]
 database = ~/.pizzaapp/db.sqlite3
 log = ~/.pizzaapp/log/
+
+[orders]
+# New orders are inserted in groups. A group is inserted as soon as it contains batch_size orders
+# or batch_window_ms milliseconds passed since the first order of the group arrived.
+batch_size = 64
+batch_window_ms = 5
+
+[security]
+# Secret mixed into the hashes of refresh and access tokens. It's generated when the config file is
+# created. Keep it secret and don't change it, otherwise all issued tokens become invalid.
+# If empty, tokens are hashed with the slow legacy scheme.
+token_pepper =
+# If yes, access tokens carry the user, their refresh token and their expiration time and are signed
+# with a key derived from the token pepper. Checking them doesn't require a database query. Revoked
+# access tokens are only known to the process which revoked them until they expire.
+signed_access_tokens = no
+
+[archive]
+# Completed orders are moved to the archive tables once they were completed max_age_hours hours ago.
+# The archive job looks for such orders every interval_minutes minutes and moves at most batch_size
+# orders in one transaction.
+max_age_hours = 24
+interval_minutes = 10
+batch_size = 500
+
+[token_sweep]
+# Expired access tokens and replaced refresh tokens are deleted every interval_minutes minutes, at most
+# batch_size rows in one transaction. Replaced refresh tokens are kept for refresh_token_retention_days
+# days, so that their reuse is still detected and expires all accesses of the user.
+interval_minutes = 30
+batch_size = 500
+refresh_token_retention_days = 30
 """
 
 # Names for required database tables used by the backend.
@@ -18,8 +50,15 @@ NAMES_OF_TABLES = {
     "item_table": "item",
     "item_price_table": "item_price",
     "item_speciality_table": "item_speciality",
+    "catalog_version_table": "catalog_version",
+    "catalog_change_table": "catalog_change",
     "order_table": "order_details",
     "order_item_table": "order_item",
+    "order_change_sequence_table": "order_change_sequence",
+    "archived_order_table": "archived_order",
+    "archived_order_item_table": "archived_order_item",
+    "hourly_order_stats_table": "hourly_order_stats",
+    "item_sales_stats_table": "item_sales_stats",
     "delivery_user_table": "delivery_user",
     "refresh_token_table": "refresh_token",
     "refresh_token_description_table": "refresh_token_description",
@@ -32,17 +71,117 @@ NAMES_OF_TABLES = {
 # Will select a random length out of the range for better security.
 TOKEN_LENGTH = range(64, 72 + 1, 2)
 
+# Versions of the schemes with which refresh and access tokens are hashed before they're stored.
+# Legacy: 5000 chained SHA-256 rounds. HMAC: HMAC-SHA256 keyed with the token pepper from the config.
+# Tokens are random, so a single keyed hash is enough to protect them if the database leaks.
+TOKEN_HASH_VERSION_LEGACY = 1
+TOKEN_HASH_VERSION_HMAC = 2
+
+# Version byte at the start of signed access tokens. A signed access token consists of the version,
+# the user id, a fingerprint of its refresh token and its expiration time, followed by a truncated
+# HMAC-SHA256 of these fields. As hex it's 66 characters long, which is one of the TOKEN_LENGTH lengths.
+SIGNED_ACCESS_TOKEN_VERSION = 1
+SIGNED_ACCESS_TOKEN_MAC_SIZE = 16  # Value in bytes.
+
 # The maximal amount of valid refresh tokens a user can have at the same time.
 MAX_REFRESH_TOKENS = 10
 
+# Maximum length of the device description a client can send when logging in, in characters.
+DEVICE_DESCRIPTION_MAX_LENGTH = 200
+
+# Amount of worker processes verifying passwords. Verifying a password takes about 100 ms of CPU time,
+# which would block other requests if done on the request thread.
+PASSWORD_WORKERS = 2
+
+# Maximum amount of password verifications which are queued or running at the same time. Further
+# logins are rejected until verifications finished.
+PASSWORD_MAX_PENDING = 16
+
+# Maximum time a login waits for its password verification.
+PASSWORD_VERIFY_TIMEOUT = 5  # Value in seconds.
+
+# Time after which clients should retry a login which was rejected because too many logins were pending.
+LOGIN_RETRY_AFTER = 2  # Value in seconds.
+
 # Time access tokens should be marked as valid when they are created.
 ACCESS_TOKEN_VALID_TIME = 600  # Value in seconds.
 
+# Maximum amount of verified access tokens kept in memory, so that requests with the same access
+# token don't need to verify it again.
+ACCESS_TOKEN_CACHE_SIZE = 10000
+
+# Maximum time a verified access token is kept in memory. Other backend processes don't notice when
+# a user's tokens are revoked, so they might accept a revoked access token for this time.
+ACCESS_TOKEN_CACHE_TIME = 60  # Value in seconds.
+
 # The transition time is the time a new access token can be already issued when
 # the previouse access token is still valid for equal or less the time specified.
 # This allows for a smoother and faster access token transition.
 ACCESS_TOKEN_TRANSITION_TIME = 20  # Value in seconds.
 
+# Time clients may use a cached catalog response before they need to revalidate it.
+# Revalidation is cheap, because the catalog responds with 304 if the clients ETag still matches.
+CATALOG_MAX_AGE = 60  # Value in seconds.
+
+# Interval in which the backend checks if the catalog version changed and reloads the catalog if so.
+CATALOG_REFRESH_INTERVAL = 5  # Value in seconds.
+
+# Maximum amount of items a catalog search responds with.
+CATALOG_SEARCH_MAX_RESULTS = 100
+
+# Response bodies smaller than this aren't compressed, because compression barely saves anything for them.
+COMPRESSION_MIN_SIZE = 1024  # Value in bytes.
+
+# Compression level used for gzip and deflate encoded responses (1 fastest to 9 best compression).
+COMPRESSION_LEVEL = 6
+
+# Maximum time a request waits for its new order to be inserted by the order ingestor.
+ORDER_INGEST_TIMEOUT = 10  # Value in seconds.
+
+# Orders with a progress (in percent) of at least this value are completed.
+ORDER_COMPLETED_PROGRESS = 100
+
+# Maximum amount of order progresses held in memory to answer progress requests without the database.
+PROGRESS_CACHE_SIZE = 10000
+
+# Maximum time a progress subscription request waits for a progress change before responding.
+# Should be shorter than the timeouts of proxies and clients.
+PROGRESS_SUBSCRIBE_TIMEOUT = 25  # Value in seconds.
+
+# Maximum amount of progress subscription requests waiting at the same time.
+PROGRESS_MAX_SUBSCRIPTIONS = 1000
+
+# Maximum amount of progress updates which can be submitted at once with a bulk progress update request.
+PROGRESS_BULK_MAX_UPDATES = 100
+
+# Amount of orders read from the database at once when streaming order listings.
+ORDER_STREAM_CHUNK_SIZE = 100
+
+# Maximum amount of changed orders on one page of an order listing.
+ORDER_PAGE_MAX_SIZE = 200
+
+# Interval in which the grouping of uncompleted orders for dispatch is reloaded completely instead of
+# only applying changed orders.
+DISPATCH_RELOAD_INTERVAL = 3600  # Value in seconds.
+
+# Size of the time buckets in which order counters are kept.
+STATS_BUCKET_SIZE = 3600  # Value in seconds.
+
+# Maximum amount of hours for which hourly order counters can be requested at once.
+STATS_MAX_HOURS = 24 * 7
+
+# Maximum amount of different items in one order.
+ORDER_MAX_ITEMS = 50
+
+# Maximum quantity of a single item in one order.
+ORDER_ITEM_MAX_QUANTITY = 100
+
+# Maximum length of each detail of an order, like the name or the street, in characters.
+ORDER_DETAIL_MAX_LENGTH = 200
+
+# Maximum amount of orders which can be submitted at once with a batch order request.
+ORDER_BATCH_MAX_ORDERS = 100
+
 # A code parsed in the body which allow the app to exactly identify the error.
 # For example a code of 701 could signal that the authentication details are invalid.
 # This is better and more exact then interpreting a general error code like 401.
@@ -63,4 +202,12 @@ APP_ERROR_CODES = {
     "access_token_not_expired": 705,
     "order_not_valid": 706,
     "invalid_access_token": 707,
+    # Too many clients are waiting for progress changes. The client should poll again later.
+    "too_many_subscriptions": 708,
+    # The order was updated by someone else since the client fetched it. The response contains
+    # the current version of the order.
+    "order_version_conflict": 709,
+    # Too many logins are being processed at the moment. The client should retry after the time
+    # given in the Retry-After header.
+    "login_busy": 710,
 }
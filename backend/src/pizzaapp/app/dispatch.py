@@ -0,0 +1,133 @@
+"""Group uncompleted orders by delivery area, so that drivers can deliver orders of the same area at once.
+
+The grouping is kept in memory. It's loaded once and then kept up to date by only reading orders whose
+change sequence number (see OrderChangeSequence) is higher than the highest one already applied.
+New and updated uncompleted orders are added to their group, completed orders are removed.
+"""
+
+import time
+
+from threading import Lock
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Engine
+
+from pizzaapp.app import defaults
+from pizzaapp.app.order import ORDER_CHANGE_SEQUENCE_ID, ORDER_IS_OPEN
+from pizzaapp.app.tables import Order, OrderChangeSequence
+
+_DISPATCH_COLUMNS = (
+    Order.order_id,
+    Order.first_name,
+    Order.last_name,
+    Order.street,
+    Order.city,
+    Order.postal_code,
+    Order.order_progress,
+    Order.change_seq,
+)
+
+
+class DeliveryArea(NamedTuple):
+    postal_code: str
+    city: str
+
+
+class DispatchIndex:
+    """Uncompleted orders grouped by delivery area.
+
+    Orders which are archived are completed already and were removed when their completion was applied.
+    To be safe against missed changes the grouping is still reloaded completely from time to time.
+
+    :param engine: Engine used to read the orders.
+    :param reload_interval: Interval in seconds in which the grouping is reloaded completely.
+    """
+
+    def __init__(self, engine: Engine, reload_interval: int = defaults.DISPATCH_RELOAD_INTERVAL):
+        self.engine = engine
+        self.reload_interval = reload_interval
+        self._lock = Lock()
+        self._areas: dict[DeliveryArea, dict[int, dict]] = {}
+        self._order_areas: dict[int, DeliveryArea] = {}
+        self._cursor = 0  # Highest applied change sequence number.
+        self._loaded_at: Optional[float] = None
+        self._groups_json: Optional[list[dict]] = None
+
+    def _apply(self, row):
+        """Add, move or remove an order depending on its current state."""
+        area = self._order_areas.pop(row.order_id, None)
+        if area is not None:
+            orders = self._areas[area]
+            del orders[row.order_id]
+            if not orders:
+                del self._areas[area]
+
+        if row.order_progress < defaults.ORDER_COMPLETED_PROGRESS:
+            area = DeliveryArea(row.postal_code, row.city)
+            self._areas.setdefault(area, {})[row.order_id] = {
+                "order_id": row.order_id,
+                "first_name": row.first_name,
+                "last_name": row.last_name,
+                "street": row.street,
+                "order_progress": row.order_progress,
+            }
+            self._order_areas[row.order_id] = area
+
+    def _reload(self, connection: Connection):
+        """Load all uncompleted orders, dropping the current grouping."""
+        # Read the cursor before the orders. Orders changed in between are applied again on the next
+        # refresh, which doesn't change the result.
+        stmt = select(OrderChangeSequence.value).where(
+            OrderChangeSequence.sequence_id == ORDER_CHANGE_SEQUENCE_ID
+        )
+        cursor = connection.execute(stmt).scalar_one_or_none() or 0
+
+        self._areas = {}
+        self._order_areas = {}
+        stmt = select(*_DISPATCH_COLUMNS).where(ORDER_IS_OPEN).order_by(Order.postal_code, Order.city)
+        for row in connection.execute(stmt):
+            self._apply(row)
+        self._cursor = cursor
+        self._loaded_at = time.monotonic()
+        self._groups_json = None
+
+    def _refresh(self, connection: Connection):
+        """Apply all orders which changed since the last refresh."""
+        stmt = select(*_DISPATCH_COLUMNS).where(Order.change_seq > self._cursor).order_by(Order.change_seq)
+        for row in connection.execute(stmt):
+            self._apply(row)
+            self._cursor = row.change_seq
+            self._groups_json = None
+
+    def get_groups(self, postal_code: Optional[str] = None) -> dict:
+        """Get the current grouping of uncompleted orders, areas with the most orders first.
+
+        :param postal_code: If set only areas with this postal code are returned.
+        """
+        with self._lock:
+            with self.engine.connect() as connection:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at > self.reload_interval:
+                    self._reload(connection)
+                else:
+                    self._refresh(connection)
+
+            if self._groups_json is None:
+                groups = [
+                    {
+                        "postal_code": area.postal_code,
+                        "city": area.city,
+                        "order_count": len(orders),
+                        "orders": sorted(orders.values(), key=lambda order: order["order_id"]),
+                    }
+                    for area, orders in self._areas.items()
+                ]
+                groups.sort(key=lambda group: (-group["order_count"], group["postal_code"], group["city"]))
+                self._groups_json = groups
+            groups = self._groups_json
+            cursor = self._cursor
+
+        if postal_code is not None:
+            groups = [group for group in groups if group["postal_code"] == postal_code]
+        order_count = sum(group["order_count"] for group in groups)
+        return {"groups": groups, "order_count": order_count, "cursor": cursor}
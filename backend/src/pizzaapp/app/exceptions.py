@@ -18,6 +18,22 @@ class ConfigValueNotBool(Exception):
         )
 
 
+class ConfigValueNotInt(Exception):
+    """Exception indicating that a value inside the config can't be mapped to a python integer."""
+
+    def __init__(self, key: str, value: str, config_path: str):
+        super().__init__(key, value, config_path)
+        self.key = key
+        self.value = value
+        self.config_path = config_path
+
+    def __str__(self):
+        return (
+            f'Key "{self.key}" with value "{self.value}" in '
+            f"config file {self.config_path} can't be converted to an integer."
+        )
+
+
 class RequiredTableMissing(Exception):
     """Exception raised whenever a required table is missing inside the database.
 
@@ -32,3 +48,45 @@ class RequiredTableMissing(Exception):
 
     def __str__(self):
         return f'Required table "{self.table_name}" does not exist in database ' f"at {self.db_path}."
+
+
+class RequiredColumnMissing(Exception):
+    """Exception raised whenever a required column is missing in a table of the database.
+
+    This happens if the database was created by an older version of the backend.
+    """
+
+    def __init__(self, table_name: str, column_name: str, db_path: str):
+        super().__init__(table_name, column_name, db_path)
+        self.table_name = table_name
+        self.column_name = column_name
+        self.db_path = db_path
+
+    def __str__(self):
+        return (
+            f'Required column "{self.column_name}" of table "{self.table_name}" does not exist in '
+            f"database at {self.db_path}. Migrate the database with the database CLI tool (--migrate)."
+        )
+
+
+class SchemaViolation(Exception):
+    """Exception raised when a value doesn't match a schema (see schema.py).
+
+    The path lists the keys and list indexes leading from the validated value to the invalid value.
+    """
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+        self.path = []
+
+    def __str__(self):
+        path = "".join(f"[{key!r}]" for key in self.path)
+        return f"Value at body{path} {self.message}"
+
+
+class PasswordVerifierBusy(Exception):
+    """Exception raised when a password can't be verified because too many verifications are pending."""
+
+    def __str__(self):
+        return "Too many password verifications are pending."
@@ -0,0 +1,132 @@
+"""Insert new orders to the database in groups.
+
+Each committed SQLite transaction costs a full fsync. Instead of committing every new order
+on its own, the order ingestor collects orders which are submitted at about the same time and
+inserts them in a single transaction. Every submitter still receives the id of its own order.
+"""
+
+import threading
+import time
+
+from concurrent.futures import Future
+from dataclasses import dataclass
+from queue import Empty as QueueEmptyError, Queue
+from typing import Callable, Optional
+
+from loguru import logger
+from sqlalchemy.engine import Engine
+
+from pizzaapp.app.order import insert_orders
+from pizzaapp.app.tables import Order
+
+
+@dataclass
+class PendingOrder:
+    """A submitted order waiting to be inserted."""
+
+    order: Order
+    future: Future
+
+
+class OrderIngestor:
+    """Collect submitted orders and insert them in groups.
+
+    :param engine: Engine used to insert the orders.
+    :param batch_size: Maximum amount of orders inserted in one transaction.
+    :param batch_window: Maximum time in seconds to wait for further orders after the first
+        order of a group was received.
+    :param on_insert: Optional function called after a group of orders was committed.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        batch_size: int,
+        batch_window: float,
+        on_insert: Optional[Callable[[], None]] = None,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.on_insert = on_insert
+        self._queue = Queue()
+
+    def submit(self, order: Order) -> Future:
+        """Submit a new order to be inserted.
+
+        :returns: A future which resolves to the order id once the order is committed.
+        """
+        future = Future()
+        self._queue.put_nowait(PendingOrder(order, future))
+        return future
+
+    def next_batch(self, timeout: float) -> Optional[list[PendingOrder]]:
+        """Wait for submitted orders and collect them to a group.
+
+        :param timeout: Maximum time in seconds to wait for the first order.
+        :returns: List of pending orders, none if no order was submitted within the timeout.
+        """
+        try:
+            first_order = self._queue.get(timeout=timeout)
+        except QueueEmptyError:
+            return None
+
+        batch = [first_order]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except QueueEmptyError:
+                break
+        return batch
+
+    def insert_batch(self, batch: list[PendingOrder]):
+        """Insert a group of orders in a single transaction and resolve their futures.
+
+        If the group can't be inserted the futures of its orders fail with the error.
+        """
+        try:
+            with self.engine.begin() as connection:
+                order_ids = insert_orders(connection, [pending.order for pending in batch])
+        except Exception as error:
+            logger.exception(f"Couldn't insert group of {len(batch)} orders.")
+            for pending in batch:
+                pending.future.set_exception(error)
+            return
+
+        if self.on_insert is not None:
+            try:
+                self.on_insert()
+            except Exception:
+                # The orders are committed, their submitters still receive the order ids.
+                logger.exception("Couldn't notify about inserted orders.")
+        for pending, order_id in zip(batch, order_ids):
+            pending.future.set_result(order_id)
+        logger.debug(f"Inserted group of {len(batch)} orders.")
+
+
+def run_ingest_thread(ingestor: OrderIngestor, kill_event: threading.Event, refresh_interval=0.5):
+    """Insert orders submitted to the ingestor until the kill event is set.
+
+    :param ingestor: Order ingestor whose submitted orders are inserted.
+    :param kill_event: A event signalizing this thread to terminate. Orders which were
+        already submitted are still inserted before the thread terminates.
+    :param refresh_interval: Optional interval in which to check the kill event while no
+        orders are submitted. Defaults to 0.5 seconds.
+    """
+    while True:
+        batch = ingestor.next_batch(timeout=refresh_interval)
+        if batch is not None:
+            try:
+                ingestor.insert_batch(batch)
+            except Exception:
+                # Keep inserting the orders of other groups.
+                logger.exception("Couldn't insert group of orders.")
+        elif kill_event.is_set():
+            break
+
+    thread = threading.current_thread()
+    logger.info(f"Shutting down {thread.name} thread (TID: {thread.native_id}).")
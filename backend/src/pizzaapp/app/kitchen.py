@@ -0,0 +1,88 @@
+"""Summarize which items the kitchen still needs to prepare.
+
+The summary contains the outstanding quantity of each item over all uncompleted orders, grouped by
+category. It's computed by the database with a single grouped query and cached until orders are
+created or their progress changes.
+"""
+
+from threading import Lock
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection, Engine
+
+from pizzaapp.app.order import ORDER_IS_OPEN
+from pizzaapp.app.tables import Category, Item, Order, OrderItem
+
+
+def get_outstanding_items(connection: Connection) -> dict:
+    """Get the outstanding quantity of each item over all uncompleted orders, grouped by category.
+
+    Only uncompleted orders are read (using the partial index on uncompleted orders) and their items
+    are summed up from the covering index on the order id of ordered items. Ordered items whose item
+    was removed from the catalog aren't included.
+    """
+    stmt = (
+        select(
+            Category.category_id,
+            Category.name.label("category_name"),
+            Item.item_id,
+            Item.name.label("item_name"),
+            func.sum(OrderItem.quantity).label("quantity"),
+        )
+        .select_from(Order)
+        .join(OrderItem, OrderItem.order_id == Order.order_id)
+        .join(Item, Item.item_id == OrderItem.item_id)
+        .join(Category, Category.category_id == Item.category_id)
+        # Without table statistics SQLite would scan all ordered items. Telling it that few orders are
+        # uncompleted lets it start from the partial index on uncompleted orders instead.
+        .where(ORDER_IS_OPEN, func.unlikely(ORDER_IS_OPEN))
+        .group_by(OrderItem.item_id)
+        .order_by(Category.category_id, Item.item_id)
+    )
+
+    categories = []
+    for row in connection.execute(stmt):
+        if not categories or categories[-1]["category_id"] != row.category_id:
+            categories.append({"category_id": row.category_id, "name": row.category_name, "items": []})
+        item = {"item_id": row.item_id, "name": row.item_name, "quantity": row.quantity}
+        categories[-1]["items"].append(item)
+    return {"categories": categories}
+
+
+class KitchenView:
+    """Cache the outstanding items until orders change.
+
+    Each change of orders increments a generation. A cached summary is only used while the generation
+    it was computed in is still the current one. Call invalidate after a change was committed.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._lock = Lock()
+        self._generation = 0
+        self._summary: Optional[dict] = None
+        self._summary_generation = -1
+
+    def invalidate(self):
+        """Mark the cached summary as outdated."""
+        with self._lock:
+            self._generation += 1
+            self._summary = None
+
+    def get_summary(self) -> dict:
+        """Get the outstanding items, computing them if the cached summary is outdated."""
+        with self._lock:
+            generation = self._generation
+            if self._summary is not None and self._summary_generation == generation:
+                return self._summary
+
+        # Orders could change while the summary is computed. The summary is only cached if no change
+        # was committed in the meantime.
+        with self.engine.connect() as connection:
+            summary = get_outstanding_items(connection)
+        with self._lock:
+            if self._generation == generation:
+                self._summary = summary
+                self._summary_generation = generation
+        return summary
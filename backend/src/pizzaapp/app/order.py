@@ -3,113 +3,455 @@
 For example includes functions to extract order data from a HTTP request.
 """
 
-from typing import Optional
+import base64
+import binascii
+import json
+
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import arrow
 
-from box import Box
 from loguru import logger
+from sqlalchemy import insert, literal_column, select, text, update
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.orm import selectinload, Session
 
 from pizzaapp.app import catalog as catalog_helper
+from pizzaapp.app import defaults
+from pizzaapp.app import schema
+from pizzaapp.app import stats
+from pizzaapp.app.cache import BoundedCache
 from pizzaapp.app.catalog import Catalog
-from pizzaapp.app.tables import Order, OrderItem
-from pizzaapp.app.utils import check_fields, Field
-
-
-def check_new_order_body(body: Box) -> bool:
-    """Check if all sections and fields exist, have the valid format and have the valid type."""
-    sections = [Field("details", dict), Field("items", list)]
-    if not check_fields(body, sections):
-        logger.debug("Wrong order sections in request.")
-        return False
-
-    items_ordered = len(body["items"])
-    if items_ordered < 1 or items_ordered > 50:
-        logger.debug(f"Amount of items ({items_ordered}) is not in required range.")
-        return False
-
-    detail_fields = [
-        Field("first_name", str),
-        Field("last_name", str),
-        Field("street", str),
-        Field("city", str),
-        Field("postal_code", str),
-    ]
-    if not check_fields(body.details, detail_fields):
-        logger.debug("Wrong order detail section in request.")
-        return False
-    if not body.details.postal_code.isdecimal():
-        logger.debug("Postal code field of order details contains characters other than numbers.")
-        return False
-
-    item_fields = [Field("item_id", int), Field("price", float), Field("quantity", int)]
-    for item in body["items"]:
-        if not isinstance(item, dict):
-            return False
-        if not check_fields(item, item_fields):
-            logger.debug("Wrong fields for an item in items section.")
-            return False
-    return True
-
-
-def check_update_progress_body(body: Box) -> bool:
-    fields = [Field("order_id", int), Field("new_progress", int)]
-    if not check_fields(body, fields):
-        logger.info("Wrong update progress body fields in request.")
-        return False
-    return True
-
-
-def check_get_progress_body(body: Box) -> bool:
-    fields = [Field("order_id", int)]
-    if not check_fields(body, fields):
-        logger.info("Wrong update progress body fields in request.")
-        return False
-    return True
-
-
-def get_new_order(catalog: Catalog, body: Box) -> Optional[Order]:
-    """Get a new order from a request body."""
-    order_body_valid = check_new_order_body(body)
-    if not order_body_valid:
+from pizzaapp.app.progress_hub import ProgressHub
+from pizzaapp.app.tables import ArchivedOrder, Order, OrderChangeSequence, OrderItem
+
+# Primary key of the single row in the order change sequence table.
+ORDER_CHANGE_SEQUENCE_ID = 1
+
+# Condition matching uncompleted orders. The progress is compared to a literal value, so that SQLite
+# can use the partial index on uncompleted orders.
+ORDER_IS_OPEN = Order.order_progress < literal_column(str(defaults.ORDER_COMPLETED_PROGRESS))
+
+
+@dataclass
+class ProgressUpdate:
+    """A new progress for an order.
+
+    If version is set the update is only applied if the order still has this version.
+    """
+
+    order_id: int
+    new_progress: int
+    version: Optional[int] = None
+
+
+@dataclass
+class ProgressUpdateResult:
+    """Result of a progress update."""
+
+    order_id: int
+    order_progress: int  # Progress of the update.
+    updated: bool
+    # Version of the order after the update, or the current version if the update was rejected.
+    # None if the order doesn't exist.
+    version: Optional[int]
+
+    def response_json(self) -> dict:
+        return {
+            "order_id": self.order_id,
+            "order_progress": self.order_progress,
+            "updated": self.updated,
+            "version": self.version,
+        }
+
+
+@dataclass
+class OrderPageToken:
+    """Position in a listing of changed orders from which the next page continues.
+
+    Clients only see the encoded token, which they pass back unchanged to get the next page.
+    """
+
+    after: int  # Change sequence number of the last change on the previous page.
+    include_completed: bool  # If ids of completed orders are listed.
+
+    def encode(self) -> str:
+        data = json.dumps([self.after, self.include_completed]).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("ascii")
+
+    @staticmethod
+    def decode(token: str) -> Optional["OrderPageToken"]:
+        """Decode a page token.
+
+        :returns: The decoded page token or None if the token is invalid.
+        """
+        try:
+            after, include_completed = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        except (binascii.Error, UnicodeError, ValueError, TypeError):
+            logger.debug("Page token couldn't be decoded.")
+            return None
+        if type(after) is not int or after < 0 or type(include_completed) is not bool:
+            logger.debug("Page token has invalid values.")
+            return None
+        return OrderPageToken(after, include_completed)
+
+
+# Validators of order request bodies.
+_PROGRESS_UPDATE = schema.Object(
+    {
+        "order_id": schema.Integer(minimum=1),
+        "new_progress": schema.Integer(minimum=0, maximum=defaults.ORDER_COMPLETED_PROGRESS),
+        "version": schema.Integer(minimum=0),
+    },
+    optional=["version"],
+)
+
+new_order_validator = schema.Validator(
+    schema.Object(
+        {
+            "details": schema.Object(
+                {
+                    "first_name": schema.String(min_length=1, max_length=defaults.ORDER_DETAIL_MAX_LENGTH),
+                    "last_name": schema.String(min_length=1, max_length=defaults.ORDER_DETAIL_MAX_LENGTH),
+                    "street": schema.String(min_length=1, max_length=defaults.ORDER_DETAIL_MAX_LENGTH),
+                    "city": schema.String(min_length=1, max_length=defaults.ORDER_DETAIL_MAX_LENGTH),
+                    "postal_code": schema.String(
+                        min_length=1, max_length=defaults.ORDER_DETAIL_MAX_LENGTH, decimal=True
+                    ),
+                }
+            ),
+            "items": schema.List(
+                schema.Object(
+                    {
+                        "item_id": schema.Integer(minimum=1),
+                        "price": schema.Number(minimum=0),
+                        "quantity": schema.Integer(minimum=1, maximum=defaults.ORDER_ITEM_MAX_QUANTITY),
+                    }
+                ),
+                min_length=1,
+                max_length=defaults.ORDER_MAX_ITEMS,
+            ),
+        }
+    )
+)
+# The orders of a batch are validated one by one when they are created.
+new_order_batch_validator = schema.Validator(
+    schema.Object(
+        {"orders": schema.List(schema.AnyObject(), min_length=1, max_length=defaults.ORDER_BATCH_MAX_ORDERS)}
+    )
+)
+update_progress_validator = schema.Validator(_PROGRESS_UPDATE)
+bulk_update_progress_validator = schema.Validator(
+    schema.Object(
+        {
+            "updates": schema.List(
+                _PROGRESS_UPDATE, min_length=1, max_length=defaults.PROGRESS_BULK_MAX_UPDATES
+            )
+        }
+    )
+)
+get_progress_validator = schema.Validator(schema.Object({"order_id": schema.Integer(minimum=1)}))
+subscribe_progress_validator = schema.Validator(
+    schema.Object(
+        {
+            "order_id": schema.Integer(minimum=1),
+            "known_progress": schema.Integer(minimum=0, maximum=defaults.ORDER_COMPLETED_PROGRESS),
+        }
+    )
+)
+
+
+def get_new_order(catalog: Catalog, body: dict) -> Optional[Order]:
+    """Get a new order from a request body.
+
+    :returns: The new order, none if the body is invalid or contains an item with a wrong price.
+    """
+    order_body = new_order_validator.validate(body)
+    if order_body is None:
         return None
 
+    details = order_body["details"]
     order = Order(
-        first_name=body.details.first_name,
-        last_name=body.details.last_name,
-        street=body.details.street,
-        city=body.details.city,
-        postal_code=body.details.postal_code,
+        first_name=details["first_name"],
+        last_name=details["last_name"],
+        street=details["street"],
+        city=details["city"],
+        postal_code=details["postal_code"],
     )
-    for item in body["items"]:
-        order_item = OrderItem(item_id=item.item_id, unit_price=item.price, quantity=item.quantity)
+    for item in order_body["items"]:
+        # Store the price from the catalog and not the price sent by the client.
+        unit_price = catalog_helper.get_item_price(catalog, item["item_id"], item["price"])
+        if unit_price is None:
+            return None
+        order_item = OrderItem(item_id=item["item_id"], unit_price=unit_price, quantity=item["quantity"])
         order.items.append(order_item)
 
-    if not catalog_helper.items_valid(catalog, order.items):
-        return None
-
     return order
 
 
-def get_existing_order(session: Session, order_id: int) -> Optional[Order]:
-    order_results = session.query(Order).where(Order.order_id == order_id)
-    order = order_results.one_or_none()
-    return order
+def reserve_change_seqs(connection: Connection, amount: int = 1) -> int:
+    """Reserve change sequence numbers for created or updated orders.
+
+    Must be called in the same transaction which writes the orders. The transaction holds the
+    write lock from this point on, so change sequence numbers are committed in increasing order.
+
+    :param amount: Amount of change sequence numbers to reserve.
+    :returns: The first reserved change sequence number. The others directly follow it.
+    """
+    sequence_table = OrderChangeSequence.__table__
+    stmt = (
+        update(sequence_table)
+        .where(sequence_table.c.sequence_id == ORDER_CHANGE_SEQUENCE_ID)
+        .values(value=sequence_table.c.value + amount)
+    )
+    result = connection.execute(stmt)
+    if result.rowcount == 0:
+        connection.execute(insert(sequence_table).values(sequence_id=ORDER_CHANGE_SEQUENCE_ID, value=amount))
+
+    stmt = select(sequence_table.c.value).where(sequence_table.c.sequence_id == ORDER_CHANGE_SEQUENCE_ID)
+    last_change_seq = connection.execute(stmt).scalar_one()
+    return last_change_seq - amount + 1
 
 
-def update_progress(session: Session, order: Order, new_progress: int):
-    order.order_progress = new_progress
-    session.add(order)
-    session.commit()
+def insert_orders(connection: Connection, orders: list[Order]) -> list[int]:
+    """Insert new orders and their items using one bulk insert for each table.
 
+    The order counters (see stats.py) are updated in the same transaction.
 
-def get_progress(session: Session, order_id: int) -> Optional[int]:
-    order = get_existing_order(session, order_id)
-    if order is None:
+    The connection needs to be in a transaction, which is committed by the caller.
+
+    :param orders: New (transient) order objects.
+    :returns: The ids of the inserted orders in the same order as the orders were passed.
+    """
+    if not orders:
+        return []
+    first_change_seq = reserve_change_seqs(connection, len(orders))
+    created_time = arrow.now().int_timestamp
+    order_rows = [
+        {
+            "first_name": order.first_name,
+            "last_name": order.last_name,
+            "street": order.street,
+            "city": order.city,
+            "postal_code": order.postal_code,
+            "change_seq": first_change_seq + index,
+            "created_time": created_time,
+        }
+        for index, order in enumerate(orders)
+    ]
+    connection.execute(insert(Order.__table__), order_rows)
+    # The pysqlite driver can't return the ids of rows inserted with executemany. SQLite assigns each new
+    # row the largest id ever used in the table plus one (the table uses AUTOINCREMENT). Other connections
+    # can't insert while this transaction holds the write lock, so the inserted orders got consecutive ids
+    # ending with the last inserted id.
+    last_order_id = connection.execute(text("SELECT last_insert_rowid()")).scalar_one()
+    order_ids = list(range(last_order_id - len(orders) + 1, last_order_id + 1))
+
+    item_rows = [
+        {
+            "order_id": order_id,
+            "item_id": item.item_id,
+            "unit_price": item.unit_price,
+            "quantity": item.quantity,
+        }
+        for order, order_id in zip(orders, order_ids)
+        for item in order.items
+    ]
+    if item_rows:
+        connection.execute(insert(OrderItem.__table__), item_rows)
+    stats.record_order_stats(connection, orders, created_time)
+    return order_ids
+
+
+def insert_order_batch(connection: Connection, new_orders: list[Optional[Order]]) -> list[dict]:
+    """Insert the valid orders of a batch order request.
+
+    The connection needs to be in a transaction, which is committed by the caller.
+
+    :param new_orders: New order objects, none for each order of the request which is invalid.
+    :returns: A result for each order in the same order as the orders were passed: either the order
+        id or an error.
+    """
+    valid_orders = [new_order for new_order in new_orders if new_order is not None]
+    order_ids = iter(insert_orders(connection, valid_orders))
+    app_error_key = "order_not_valid"
+    error = {"app_error_key": app_error_key, "app_error_code": defaults.APP_ERROR_CODES[app_error_key]}
+    return [
+        {"error": error} if new_order is None else {"order_id": next(order_ids)} for new_order in new_orders
+    ]
+
+
+def get_progress_update(body: dict) -> ProgressUpdate:
+    """Get a progress update from a validated request body."""
+    return ProgressUpdate(body["order_id"], body["new_progress"], body["version"])
+
+
+def apply_progress_updates(
+    connection: Connection, updates: list[ProgressUpdate]
+) -> list[ProgressUpdateResult]:
+    """Update the progress of orders.
+
+    Each update is a single conditional UPDATE statement: If the update contains the version of the
+    order the client knows, the order is only updated if it still has this version. Otherwise another
+    client updated the order in the meantime and the update is rejected. Each successful update
+    increments the version of the order.
+
+    The connection needs to be in a transaction, which is committed by the caller.
+
+    :returns: A result for each update in the same order as the updates were passed.
+    """
+    order_table = Order.__table__
+    first_change_seq = reserve_change_seqs(connection, len(updates))
+    now = arrow.now().int_timestamp
+    results = []
+    for index, progress_update in enumerate(updates):
+        completed = progress_update.new_progress >= defaults.ORDER_COMPLETED_PROGRESS
+        stmt = (
+            update(order_table)
+            .where(order_table.c.order_id == progress_update.order_id)
+            .values(
+                order_progress=progress_update.new_progress,
+                version=order_table.c.version + 1,
+                change_seq=first_change_seq + index,
+                completed_time=now if completed else None,
+            )
+        )
+        if progress_update.version is not None:
+            stmt = stmt.where(order_table.c.version == progress_update.version)
+        updated = connection.execute(stmt).rowcount == 1
+
+        if updated and progress_update.version is not None:
+            version = progress_update.version + 1
+        else:
+            # Get the new version of an unconditional update or the current version if the update
+            # was rejected.
+            stmt = select(order_table.c.version).where(order_table.c.order_id == progress_update.order_id)
+            version = connection.execute(stmt).scalar_one_or_none()
+        results.append(
+            ProgressUpdateResult(progress_update.order_id, progress_update.new_progress, updated, version)
+        )
+    return results
+
+
+def publish_progress_updates(
+    results: list[ProgressUpdateResult], progress_hub: ProgressHub, progress_cache: BoundedCache
+):
+    """Update the progress cache and notify requests waiting for progress changes.
+
+    Only call this after the progress updates were committed. Concurrent requests can publish their
+    updates in a different order than they were committed, the cache keeps the progress of the newest
+    version of an order.
+    """
+    for result in results:
+        if not result.updated:
+            continue
+        progress_cache.set_versioned(result.order_id, result.version, result.order_progress)
+        progress_hub.publish(result.order_id, result.order_progress)
+
+
+def get_progress(connection: Connection, order_id: int, progress_cache: BoundedCache) -> Optional[int]:
+    """Get the progress of an order.
+
+    The progress is read from the progress cache. Only if it isn't cached the progress and version
+    columns are selected from the database. Orders which were already archived are looked up in the
+    archive. The cache holds tuples of the version and the progress of orders.
+
+    :returns: The progress of the order, none if the order doesn't exist.
+    """
+    cached = progress_cache.get(order_id)
+    if cached is not None:
+        return cached[1]
+
+    stmt = select(Order.version, Order.order_progress).where(Order.order_id == order_id)
+    row = connection.execute(stmt).one_or_none()
+    if row is None:
+        stmt = select(ArchivedOrder.version, ArchivedOrder.order_progress).where(
+            ArchivedOrder.order_id == order_id
+        )
+        row = connection.execute(stmt).one_or_none()
+    if row is None:
+        return None
+    # Another request might have cached a newer version in the meantime, which is kept.
+    progress_cache.set_versioned(order_id, row.version, row.order_progress)
+    return row.order_progress
+
+
+def get_page_limit(limit: Optional[int]) -> Optional[int]:
+    """Get the amount of changes on a page of changed orders.
+
+    :param limit: Requested amount of changes. If None the maximum page size is used.
+    :returns: The requested amount limited to the maximum page size or None if the amount is invalid.
+    """
+    if limit is None:
+        return defaults.ORDER_PAGE_MAX_SIZE
+    if limit < 1:
+        logger.debug(f"Page limit {limit} is invalid.")
         return None
-    return order.order_progress
+    return min(limit, defaults.ORDER_PAGE_MAX_SIZE)
+
+
+def generate_changed_orders_json(engine: Engine, page: OrderPageToken, limit: int) -> Iterator[str]:
+    """Generate the JSON response of a page of uncompleted orders changed after a change sequence number.
+
+    Pages are found with keyset pagination on the change sequence number, so every page is read from the
+    indexes in the same time no matter how many orders changed before it. The orders of a page are read
+    in chunks and each chunk is serialized as soon as it was read.
+
+    If page.include_completed is set orders which were completed after the change sequence number are
+    only returned by their id. This allows clients to remove them from previously fetched orders.
 
+    The response includes a token for the next page, which is None on the last page. The cursor of the
+    response is the highest change sequence number of the changes on the page.
 
-def get_all_uncompleted_orders(session: Session) -> list[Order]:
-    """Get all currently uncompleted orders."""
-    orders = session.query(Order).options(selectinload(Order.items)).all()
-    return orders
+    :param page: Position after which the page starts.
+    :param limit: Maximum amount of uncompleted orders and completed order ids on the page.
+    """
+    with Session(engine) as session:
+        # Look one change beyond the limit to know if there is a next page.
+        stmt = (
+            select(Order.change_seq)
+            .where(ORDER_IS_OPEN, Order.change_seq > page.after)
+            .order_by(Order.change_seq)
+            .limit(limit + 1)
+        )
+        changes = [(change_seq, None) for change_seq in session.execute(stmt).scalars()]
+        if page.include_completed:
+            stmt = (
+                select(Order.change_seq, Order.order_id)
+                .where(Order.change_seq > page.after, ~ORDER_IS_OPEN)
+                .order_by(Order.change_seq)
+                .limit(limit + 1)
+            )
+            changes.extend((row.change_seq, row.order_id) for row in session.execute(stmt))
+        changes.sort()
+
+        has_next_page = len(changes) > limit
+        changes = changes[:limit]
+        cursor = changes[-1][0] if changes else page.after
+        completed_order_ids = [order_id for _, order_id in changes if order_id is not None]
+
+        stmt = (
+            select(Order)
+            .options(selectinload(Order.items))
+            .where(ORDER_IS_OPEN, Order.change_seq > page.after, Order.change_seq <= cursor)
+            .order_by(Order.change_seq)
+            .execution_options(yield_per=defaults.ORDER_STREAM_CHUNK_SIZE)
+        )
+        separator = ""
+        yield '{"orders":['
+        for orders in session.execute(stmt).scalars().partitions():
+            chunk = []
+            for changed_order in orders:
+                chunk.append(separator + json.dumps(changed_order.to_json(), ensure_ascii=False))
+                separator = ","
+            yield "".join(chunk)
+
+    next_page_token = None
+    if has_next_page:
+        next_page_token = OrderPageToken(cursor, page.include_completed).encode()
+    yield (
+        f'],"completed_order_ids":{json.dumps(completed_order_ids)},'
+        f'"cursor":{cursor},"next_page_token":{json.dumps(next_page_token)},'
+        f'"time":{arrow.now().int_timestamp}}}'
+    )
@@ -0,0 +1,95 @@
+"""Verify passwords of delivery users on worker processes.
+
+Verifying a bcrypt hash intentionally takes a lot of CPU time. Done on a request thread it would hold
+the GIL and stall all other requests, for example new orders. The verifications are therefore run on a
+pool of worker processes. The amount of pending verifications is limited, so that a burst of logins
+can't build up an endless queue.
+"""
+
+import threading
+
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional
+
+from loguru import logger
+from passlib.hash import bcrypt
+
+from pizzaapp.app.exceptions import PasswordVerifierBusy
+
+
+def _verify_password(password: str, pw_hash: str) -> bool:
+    """Verify a password in a worker process."""
+    return bcrypt.verify(password, pw_hash)
+
+
+def _warm_up():
+    """Do nothing. Submitted to start the worker processes."""
+
+
+class PasswordVerifier:
+    """Verify passwords on a pool of worker processes.
+
+    :param workers: Amount of worker processes.
+    :param max_pending: Maximum amount of verifications queued or running at the same time.
+    :param timeout: Maximum time in seconds to wait for a verification.
+    """
+
+    def __init__(self, workers: int, max_pending: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def start(self):
+        """Start the worker processes.
+
+        Call this before other threads are started: Worker processes may be forked from the current
+        process, which is only safe while no other threads hold locks.
+        """
+        executor = self._get_executor()
+        futures = [executor.submit(_warm_up) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+        logger.info(f"Started {self.workers} password verification processes.")
+
+    def verify(self, password: str, pw_hash: str) -> bool:
+        """Verify a password against a bcrypt hash.
+
+        :raises PasswordVerifierBusy: If too many verifications are pending or the verification
+            didn't finish in time.
+        :returns: True if the password matches the hash, false if not.
+        """
+        if not self._slots.acquire(blocking=False):
+            logger.info("Rejecting password verification because too many verifications are pending.")
+            raise PasswordVerifierBusy()
+
+        try:
+            future = self._get_executor().submit(_verify_password, password, pw_hash)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is only free again when the worker finished, even if the caller stopped waiting.
+        future.add_done_callback(self._release_slot)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError as error:
+            logger.warning("Password verification didn't finish in time.")
+            raise PasswordVerifierBusy() from error
+
+    def _release_slot(self, future: Future):
+        self._slots.release()
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
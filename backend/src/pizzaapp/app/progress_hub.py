@@ -0,0 +1,82 @@
+"""Notify waiting requests about changes of the progress of orders.
+
+Requests waiting for a progress change subscribe to an order at the progress hub. Whenever
+the progress of an order is committed the new progress is published to the hub, which wakes up
+all requests subscribed to this order.
+"""
+
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from typing import Optional
+
+from loguru import logger
+
+
+@dataclass(eq=False)
+class ProgressSubscription:
+    """Subscription of a single waiting request to the progress of an order."""
+
+    order_id: int
+    event: Event = field(default_factory=Event)
+    progress: Optional[int] = None
+
+
+class ProgressHub:
+    """In-process publish/subscribe hub for order progress changes.
+
+    :param max_subscriptions: Maximum amount of subscriptions existing at the same time. Each
+        subscription is a request which is blocked while waiting.
+    """
+
+    def __init__(self, max_subscriptions: int):
+        self.max_subscriptions = max_subscriptions
+        self._lock = Lock()
+        self._subscriptions: dict[int, list[ProgressSubscription]] = {}
+        self._amount_subscriptions = 0
+
+    def subscribe(self, order_id: int) -> Optional[ProgressSubscription]:
+        """Subscribe to progress changes of an order.
+
+        :returns: The subscription, none if the maximum amount of subscriptions is reached.
+        """
+        with self._lock:
+            if self._amount_subscriptions >= self.max_subscriptions:
+                logger.info("Reached maximum amount of progress subscriptions.")
+                return None
+            subscription = ProgressSubscription(order_id)
+            self._subscriptions.setdefault(order_id, []).append(subscription)
+            self._amount_subscriptions += 1
+        return subscription
+
+    def unsubscribe(self, subscription: ProgressSubscription):
+        """Remove a subscription. Does nothing if it was already removed by a publish."""
+        with self._lock:
+            order_subscriptions = self._subscriptions.get(subscription.order_id)
+            if order_subscriptions is None or subscription not in order_subscriptions:
+                return
+            order_subscriptions.remove(subscription)
+            if not order_subscriptions:
+                del self._subscriptions[subscription.order_id]
+            self._amount_subscriptions -= 1
+
+    def publish(self, order_id: int, progress: int):
+        """Notify all subscriptions of an order about its new progress.
+
+        Only call this after the new progress was committed. Notified subscriptions are removed.
+        """
+        with self._lock:
+            order_subscriptions = self._subscriptions.pop(order_id, [])
+            self._amount_subscriptions -= len(order_subscriptions)
+        for subscription in order_subscriptions:
+            subscription.progress = progress
+            subscription.event.set()
+
+    @staticmethod
+    def wait(subscription: ProgressSubscription, timeout: float) -> Optional[int]:
+        """Block until the progress of the subscribed order changes.
+
+        :returns: The new progress, none if it didn't change within the timeout.
+        """
+        if subscription.event.wait(timeout):
+            return subscription.progress
+        return None
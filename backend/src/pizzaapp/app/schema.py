@@ -0,0 +1,254 @@
+"""Validate request bodies against declarative schemas.
+
+A schema describes the expected JSON value, for example an object with certain keys whose values are
+integers in a certain range. Each schema is compiled once to a Validator, which checks values without
+inspecting the schema again. Validated objects are returned as plain dicts which only contain the keys
+of the schema, so that code handling a request only sees checked values.
+
+Example:
+    validator = Validator(Object({"order_id": Integer(minimum=1)}))
+    body = validator.validate(request_json)  # None if the body is invalid.
+"""
+
+import math
+
+from typing import Any, Callable, Iterable, Optional
+
+from loguru import logger
+
+from pizzaapp.app.exceptions import SchemaViolation
+
+# A compiled check. Returns the checked value or raises SchemaViolation.
+Check = Callable[[Any], Any]
+
+
+class SchemaType:
+    """Base of all schema types.
+
+    :param nullable: If the value may be null (None) instead.
+    """
+
+    def __init__(self, nullable: bool = False):
+        self.nullable = nullable
+
+    def _compile(self) -> Check:
+        raise NotImplementedError
+
+    def compile(self) -> Check:
+        check = self._compile()
+        if not self.nullable:
+            return check
+
+        def check_nullable(value):
+            if value is None:
+                return None
+            return check(value)
+
+        return check_nullable
+
+
+class Integer(SchemaType):
+    """An integer in an optional range. Booleans aren't accepted as integers."""
+
+    def __init__(self, minimum: Optional[int] = None, maximum: Optional[int] = None, nullable: bool = False):
+        super().__init__(nullable)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def _compile(self) -> Check:
+        minimum = self.minimum
+        maximum = self.maximum
+
+        def check_integer(value):
+            if type(value) is not int:
+                raise SchemaViolation("must be an integer.")
+            if minimum is not None and value < minimum:
+                raise SchemaViolation(f"must be at least {minimum}.")
+            if maximum is not None and value > maximum:
+                raise SchemaViolation(f"must be at most {maximum}.")
+            return value
+
+        return check_integer
+
+
+class Number(SchemaType):
+    """An integer or a finite floating point number in an optional range.
+
+    NaN and infinite numbers aren't accepted, even though JSON parsers accept them.
+    """
+
+    def __init__(
+        self, minimum: Optional[float] = None, maximum: Optional[float] = None, nullable: bool = False
+    ):
+        super().__init__(nullable)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def _compile(self) -> Check:
+        minimum = self.minimum
+        maximum = self.maximum
+
+        def check_number(value):
+            if type(value) is not int and type(value) is not float:
+                raise SchemaViolation("must be a number.")
+            if not math.isfinite(value):
+                raise SchemaViolation("must be a finite number.")
+            if minimum is not None and value < minimum:
+                raise SchemaViolation(f"must be at least {minimum}.")
+            if maximum is not None and value > maximum:
+                raise SchemaViolation(f"must be at most {maximum}.")
+            return value
+
+        return check_number
+
+
+class String(SchemaType):
+    """A string with an optional length range.
+
+    :param decimal: If the string may only contain decimal characters.
+    """
+
+    def __init__(
+        self,
+        min_length: int = 0,
+        max_length: Optional[int] = None,
+        decimal: bool = False,
+        nullable: bool = False,
+    ):
+        super().__init__(nullable)
+        self.min_length = min_length
+        self.max_length = max_length
+        self.decimal = decimal
+
+    def _compile(self) -> Check:
+        min_length = self.min_length
+        max_length = self.max_length
+        decimal = self.decimal
+
+        def check_string(value):
+            if type(value) is not str:
+                raise SchemaViolation("must be a string.")
+            if len(value) < min_length:
+                raise SchemaViolation(f"must have at least {min_length} characters.")
+            if max_length is not None and len(value) > max_length:
+                raise SchemaViolation(f"must have at most {max_length} characters.")
+            if decimal and not value.isdecimal():
+                raise SchemaViolation("must only contain decimal characters.")
+            return value
+
+        return check_string
+
+
+class List(SchemaType):
+    """A list whose elements all match the same schema.
+
+    :param item: Schema of the elements.
+    """
+
+    def __init__(
+        self, item: SchemaType, min_length: int = 0, max_length: Optional[int] = None, nullable: bool = False
+    ):
+        super().__init__(nullable)
+        self.item = item
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def _compile(self) -> Check:
+        check_item = self.item.compile()
+        min_length = self.min_length
+        max_length = self.max_length
+
+        def check_list(value):
+            if type(value) is not list:
+                raise SchemaViolation("must be a list.")
+            if len(value) < min_length:
+                raise SchemaViolation(f"must have at least {min_length} elements.")
+            if max_length is not None and len(value) > max_length:
+                raise SchemaViolation(f"must have at most {max_length} elements.")
+            checked = []
+            for index, item in enumerate(value):
+                try:
+                    checked.append(check_item(item))
+                except SchemaViolation as violation:
+                    violation.path.insert(0, index)
+                    raise
+            return checked
+
+        return check_list
+
+
+class Object(SchemaType):
+    """An object with certain keys whose values match a schema each.
+
+    Keys which aren't part of the schema are dropped from the checked object.
+
+    :param fields: Schema of the value of each key.
+    :param optional: Keys which may be missing. They are set to None in the checked object.
+    """
+
+    def __init__(self, fields: dict[str, SchemaType], optional: Iterable[str] = (), nullable: bool = False):
+        super().__init__(nullable)
+        self.fields = fields
+        self.optional = frozenset(optional)
+
+    def _compile(self) -> Check:
+        field_checks = tuple(
+            (key, schema.compile(), key in self.optional) for key, schema in self.fields.items()
+        )
+
+        def check_object(value):
+            if type(value) is not dict:
+                raise SchemaViolation("must be an object.")
+            checked = {}
+            for key, check_field, optional in field_checks:
+                field_value = value.get(key)
+                if field_value is None and optional:
+                    checked[key] = None
+                    continue
+                if key not in value:
+                    violation = SchemaViolation("is missing.")
+                    violation.path.append(key)
+                    raise violation
+                try:
+                    checked[key] = check_field(field_value)
+                except SchemaViolation as violation:
+                    violation.path.insert(0, key)
+                    raise
+            return checked
+
+        return check_object
+
+
+class AnyObject(SchemaType):
+    """An object whose content isn't checked. Used for objects which are checked on their own later."""
+
+    def _compile(self) -> Check:
+        def check_any_object(value):
+            if type(value) is not dict:
+                raise SchemaViolation("must be an object.")
+            return value
+
+        return check_any_object
+
+
+class Validator:
+    """A compiled schema which validates values.
+
+    :param schema: The schema values need to match.
+    """
+
+    __slots__ = ("_check",)
+
+    def __init__(self, schema: SchemaType):
+        self._check = schema.compile()
+
+    def validate(self, value: Any) -> Optional[Any]:
+        """Validate a value.
+
+        :returns: The checked value, none if the value doesn't match the schema.
+        """
+        try:
+            return self._check(value)
+        except SchemaViolation as violation:
+            logger.debug(str(violation))
+            return None
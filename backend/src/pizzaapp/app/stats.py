@@ -0,0 +1,173 @@
+"""Keep sales and throughput counters of orders.
+
+Counters are kept per hour (amount of orders, ordered items and revenue) and per item (quantity and
+revenue). They're updated in the same transaction which inserts new orders, so reading them never
+requires to scan the order tables. If the counters ever get out of sync they can be rebuilt from the
+orders, including archived orders.
+"""
+
+from collections import defaultdict
+from typing import Iterable
+
+from sqlalchemy import delete, func, Integer, select, type_coerce
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+
+from pizzaapp.app import defaults
+from pizzaapp.app.catalog import price_to_cents
+from pizzaapp.app.tables import (
+    ArchivedOrder,
+    ArchivedOrderItem,
+    HourlyOrderStats,
+    ItemSalesStats,
+    Order,
+    OrderItem,
+)
+
+
+def get_bucket_start(timestamp: int) -> int:
+    """Get the start of the time bucket a timestamp belongs to."""
+    return timestamp - timestamp % defaults.STATS_BUCKET_SIZE
+
+
+def _add_hourly_stats(connection: Connection, rows: list[dict]):
+    """Add counters to the hourly stats, creating buckets which don't exist yet."""
+    if not rows:
+        return
+    table = HourlyOrderStats.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.bucket_start],
+        set_={
+            "order_count": table.c.order_count + stmt.excluded.order_count,
+            "item_count": table.c.item_count + stmt.excluded.item_count,
+            "revenue_cents": table.c.revenue_cents + stmt.excluded.revenue_cents,
+        },
+    )
+    connection.execute(stmt, rows)
+
+
+def _add_item_stats(connection: Connection, rows: list[dict]):
+    """Add counters to the item stats, creating items which don't exist yet."""
+    if not rows:
+        return
+    table = ItemSalesStats.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.item_id],
+        set_={
+            "quantity": table.c.quantity + stmt.excluded.quantity,
+            "revenue_cents": table.c.revenue_cents + stmt.excluded.revenue_cents,
+        },
+    )
+    connection.execute(stmt, rows)
+
+
+def record_order_stats(connection: Connection, orders: Iterable[Order], created_time: int):
+    """Add new orders to the counters.
+
+    Must be called in the same transaction which inserts the orders.
+
+    :param orders: The new orders, all created at created_time.
+    """
+    hourly_row = {
+        "bucket_start": get_bucket_start(created_time),
+        "order_count": 0,
+        "item_count": 0,
+        "revenue_cents": 0,
+    }
+    item_rows = {}
+    for order in orders:
+        hourly_row["order_count"] += 1
+        for item in order.items:
+            revenue_cents = price_to_cents(item.unit_price) * item.quantity
+            hourly_row["item_count"] += item.quantity
+            hourly_row["revenue_cents"] += revenue_cents
+            item_row = item_rows.setdefault(
+                item.item_id, {"item_id": item.item_id, "quantity": 0, "revenue_cents": 0}
+            )
+            item_row["quantity"] += item.quantity
+            item_row["revenue_cents"] += revenue_cents
+
+    if hourly_row["order_count"] > 0:
+        _add_hourly_stats(connection, [hourly_row])
+    _add_item_stats(connection, list(item_rows.values()))
+
+
+def rebuild_stats(connection: Connection):
+    """Recompute all counters from the orders and archived orders.
+
+    The connection needs to be in a transaction, which is committed by the caller.
+    """
+    connection.execute(delete(HourlyOrderStats.__table__))
+    connection.execute(delete(ItemSalesStats.__table__))
+
+    for order_table, order_item_table in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+        bucket_start = order_table.created_time - order_table.created_time % defaults.STATS_BUCKET_SIZE
+        # Prices are stored as cents, read them without converting them to decimals.
+        revenue_cents = func.sum(
+            type_coerce(order_item_table.unit_price, Integer) * order_item_table.quantity
+        )
+
+        hourly_rows = defaultdict(lambda: {"order_count": 0, "item_count": 0, "revenue_cents": 0})
+        stmt = select(bucket_start.label("bucket_start"), func.count().label("order_count")).group_by(
+            bucket_start
+        )
+        for row in connection.execute(stmt):
+            hourly_rows[row.bucket_start]["order_count"] = row.order_count
+        stmt = (
+            select(
+                bucket_start.label("bucket_start"),
+                func.sum(order_item_table.quantity).label("item_count"),
+                revenue_cents.label("revenue_cents"),
+            )
+            .join(order_item_table, order_item_table.order_id == order_table.order_id)
+            .group_by(bucket_start)
+        )
+        for row in connection.execute(stmt):
+            hourly_rows[row.bucket_start]["item_count"] = row.item_count
+            hourly_rows[row.bucket_start]["revenue_cents"] = row.revenue_cents
+        _add_hourly_stats(connection, [{"bucket_start": start, **row} for start, row in hourly_rows.items()])
+
+        stmt = (
+            select(
+                order_item_table.item_id,
+                func.sum(order_item_table.quantity).label("quantity"),
+                revenue_cents.label("revenue_cents"),
+            )
+            .where(order_item_table.item_id.is_not(None))
+            .group_by(order_item_table.item_id)
+        )
+        _add_item_stats(connection, [dict(row._mapping) for row in connection.execute(stmt)])
+
+
+def get_stats(connection: Connection, since: int, until: int) -> dict:
+    """Get the hourly counters of a time range and the counters of all items.
+
+    Only buckets in which orders were placed are returned.
+
+    :param since: Timestamp from which on to get the hourly counters.
+    :param until: Timestamp until which to get the hourly counters.
+    """
+    hourly_table = HourlyOrderStats.__table__
+    stmt = (
+        select(hourly_table)
+        .where(hourly_table.c.bucket_start >= get_bucket_start(since), hourly_table.c.bucket_start <= until)
+        .order_by(hourly_table.c.bucket_start)
+    )
+    hourly = [
+        {
+            "bucket_start": row.bucket_start,
+            "order_count": row.order_count,
+            "item_count": row.item_count,
+            "revenue": row.revenue_cents / 100,
+        }
+        for row in connection.execute(stmt)
+    ]
+    item_table = ItemSalesStats.__table__
+    stmt = select(item_table).order_by(item_table.c.item_id)
+    items = [
+        {"item_id": row.item_id, "quantity": row.quantity, "revenue": row.revenue_cents / 100}
+        for row in connection.execute(stmt)
+    ]
+    return {"bucket_size": defaults.STATS_BUCKET_SIZE, "hourly": hourly, "items": items}
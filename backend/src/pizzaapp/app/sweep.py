@@ -0,0 +1,208 @@
+"""Delete access and refresh tokens which aren't needed anymore.
+
+Each login and each refresh adds a refresh token and an access token, and a refresh marks the previous
+refresh token as invalid. The sweep deletes expired access tokens and invalid refresh tokens in small
+batches, so that the token tables and their hash indexes don't grow endlessly.
+
+Invalid refresh tokens are kept for a retention time after they were replaced. If an invalid refresh
+token is used, all accesses of its user are expired (RFC-6819 5.2.2.3). After the retention time the
+token is unknown and using it is only rejected.
+"""
+
+import threading
+
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Optional
+
+import arrow
+
+from loguru import logger
+from sqlalchemy import delete, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased
+
+from pizzaapp.app.tables import AccessToken, RefreshToken, RefreshTokenDescription
+
+
+@dataclass
+class SweepResult:
+    """Amount of rows deleted by a sweep."""
+
+    access_tokens: int = 0
+    refresh_tokens: int = 0
+    descriptions: int = 0
+
+
+def sweep_access_token_batch(connection: Connection, expired_before: int, batch_size: int) -> int:
+    """Delete a batch of access tokens which expired before a certain time.
+
+    :param expired_before: Timestamp before which the access tokens must have expired.
+    :param batch_size: Maximum amount of access tokens to delete.
+    :returns: The amount of access tokens deleted.
+    """
+    access_token_table = AccessToken.__table__
+    stmt = (
+        select(access_token_table.c.access_token_id)
+        .where(access_token_table.c.expiration_time < expired_before)
+        .limit(batch_size)
+    )
+    access_token_ids = connection.execute(stmt).scalars().all()
+    if not access_token_ids:
+        return 0
+
+    connection.execute(
+        delete(access_token_table).where(access_token_table.c.access_token_id.in_(access_token_ids))
+    )
+    return len(access_token_ids)
+
+
+def sweep_refresh_token_batch(connection: Connection, replaced_before: int, batch_size: int) -> int:
+    """Delete a batch of invalid refresh tokens which were replaced before a certain time.
+
+    A refresh token was replaced when its successor was issued. Refresh tokens replaced first are deleted
+    first, so that a refresh token is never deleted after its successor. Access tokens of deleted refresh
+    tokens are deleted by the database.
+
+    :param replaced_before: Timestamp before which the refresh tokens must have been replaced.
+    :param batch_size: Maximum amount of refresh tokens to delete.
+    :returns: The amount of refresh tokens deleted.
+    """
+    refresh_token_table = RefreshToken.__table__
+    successor = aliased(refresh_token_table)
+    stmt = (
+        select(refresh_token_table.c.refresh_token_id)
+        .join(successor, successor.c.originated_from == refresh_token_table.c.refresh_token_id)
+        .where(refresh_token_table.c.valid.is_(False), successor.c.issuing_time < replaced_before)
+        .order_by(successor.c.issuing_time)
+        .limit(batch_size)
+    )
+    refresh_token_ids = connection.execute(stmt).scalars().all()
+    if not refresh_token_ids:
+        return 0
+
+    connection.execute(
+        delete(refresh_token_table).where(refresh_token_table.c.refresh_token_id.in_(refresh_token_ids))
+    )
+    return len(refresh_token_ids)
+
+
+def sweep_description_batch(connection: Connection, batch_size: int) -> int:
+    """Delete a batch of refresh token descriptions which no refresh token refers to anymore.
+
+    :param batch_size: Maximum amount of descriptions to delete.
+    :returns: The amount of descriptions deleted.
+    """
+    description_table = RefreshTokenDescription.__table__
+    refresh_token_table = RefreshToken.__table__
+    has_refresh_tokens = (
+        select(refresh_token_table.c.refresh_token_id)
+        .where(refresh_token_table.c.description_id == description_table.c.description_id)
+        .exists()
+    )
+    stmt = select(description_table.c.description_id).where(~has_refresh_tokens).limit(batch_size)
+    description_ids = connection.execute(stmt).scalars().all()
+    if not description_ids:
+        return 0
+
+    connection.execute(
+        delete(description_table).where(description_table.c.description_id.in_(description_ids))
+    )
+    return len(description_ids)
+
+
+def _sweep_batches(
+    engine: Engine,
+    sweep_batch: Callable[[Connection], int],
+    batch_size: int,
+    kill_event: Optional[threading.Event],
+) -> int:
+    """Delete batches in their own transactions until a batch isn't full anymore.
+
+    :returns: The amount of rows deleted.
+    """
+    deleted_count = 0
+    while kill_event is None or not kill_event.is_set():
+        with engine.begin() as connection:
+            batch_count = sweep_batch(connection)
+        deleted_count += batch_count
+        if batch_count < batch_size:
+            break
+    return deleted_count
+
+
+def sweep_tokens(
+    engine: Engine,
+    refresh_token_retention: int,
+    batch_size: int,
+    kill_event: Optional[threading.Event] = None,
+) -> SweepResult:
+    """Delete expired access tokens and invalid refresh tokens which aren't needed anymore.
+
+    Each batch is deleted in its own transaction, so that the database is only locked for writing
+    shortly and other connections can write in between.
+
+    :param refresh_token_retention: Time in seconds invalid refresh tokens are kept after they
+        were replaced.
+    :param batch_size: Maximum amount of rows deleted in one transaction.
+    :param kill_event: Optional event after which no further batches are deleted.
+    :returns: The amount of deleted rows per table.
+    """
+    now = arrow.now().int_timestamp
+    # Refresh tokens go first, the database deletes their access tokens with them.
+    refresh_token_count = _sweep_batches(
+        engine,
+        partial(
+            sweep_refresh_token_batch, replaced_before=now - refresh_token_retention, batch_size=batch_size
+        ),
+        batch_size,
+        kill_event,
+    )
+    access_token_count = _sweep_batches(
+        engine,
+        partial(sweep_access_token_batch, expired_before=now, batch_size=batch_size),
+        batch_size,
+        kill_event,
+    )
+    description_count = _sweep_batches(
+        engine, partial(sweep_description_batch, batch_size=batch_size), batch_size, kill_event
+    )
+    result = SweepResult(access_token_count, refresh_token_count, description_count)
+
+    if access_token_count or refresh_token_count or description_count:
+        logger.info(
+            f"Deleted {access_token_count} access tokens, {refresh_token_count} refresh tokens "
+            f"and {description_count} refresh token descriptions."
+        )
+    return result
+
+
+def run_sweep_thread(
+    engine: Engine,
+    kill_event: threading.Event,
+    refresh_token_retention: int,
+    batch_size: int,
+    refresh_interval: int,
+):
+    """Periodically delete tokens which aren't needed anymore.
+
+    :param engine: Engine used to delete the tokens.
+    :param kill_event: A event signalizing this thread to terminate.
+    :param refresh_token_retention: Time in seconds invalid refresh tokens are kept after they
+        were replaced.
+    :param batch_size: Maximum amount of rows deleted in one transaction.
+    :param refresh_interval: Interval in seconds in which to look for tokens to delete.
+    """
+    while True:
+        kill_thread = kill_event.wait(refresh_interval)
+        if kill_thread is True:
+            break
+        try:
+            sweep_tokens(engine, refresh_token_retention, batch_size, kill_event)
+        except SQLAlchemyError:
+            # The tokens stay in the database, the next run will try again.
+            logger.exception("Couldn't delete expired tokens.")
+
+    thread = threading.current_thread()
+    logger.info(f"Shutting down {thread.name} thread (TID: {thread.native_id}).")
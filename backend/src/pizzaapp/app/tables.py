@@ -2,16 +2,14 @@
 
 from typing import Optional
 
-from box import Box
-
 from sqlalchemy.types import Boolean, Integer, String
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.orm import backref, relationship
 
 from pizzaapp.app import Base, config, inspector
 from pizzaapp.app.database import SQLiteDecimal
-from pizzaapp.app.defaults import NAMES_OF_TABLES
-from pizzaapp.app.exceptions import RequiredTableMissing
+from pizzaapp.app.defaults import NAMES_OF_TABLES, ORDER_COMPLETED_PROGRESS, TOKEN_HASH_VERSION_LEGACY
+from pizzaapp.app.exceptions import RequiredColumnMissing, RequiredTableMissing
 
 price_type = SQLiteDecimal(scale=2)
 
@@ -69,6 +67,32 @@ class ItemSpeciality(Base):
     item = relationship("Item", uselist=False, back_populates="speciality")
 
 
+class CatalogVersion(Base):
+    """A CatalogVersion holds the current version of the catalog data.
+
+    The table only contains a single row. Its version is incremented whenever catalog data changes.
+    Running backends watch the version to know when to reload the catalog.
+    """
+
+    __tablename__ = NAMES_OF_TABLES["catalog_version_table"]
+
+    version_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class CatalogChange(Base):
+    """A CatalogChange records that an item changed in a certain catalog version.
+
+    An item counts as changed if it or one of its prices or its speciality was added, changed or removed.
+    The item id isn't a foreign key because removed items are recorded too.
+    """
+
+    __tablename__ = NAMES_OF_TABLES["catalog_change_table"]
+
+    version = Column(Integer, primary_key=True)
+    item_id = Column(Integer, primary_key=True)
+
+
 # Order tables
 class Order(Base):
     """An Order holds contact and address information for a placed order.
@@ -87,21 +111,56 @@ class Order(Base):
     city = Column(String, nullable=False)
     postal_code = Column(String, nullable=False)
     order_progress = Column(Integer, default=0, nullable=False)  # Progress of the order in percent.
+    # Increasing number set whenever the order is created or updated (see OrderChangeSequence).
+    change_seq = Column(Integer, nullable=False)
+    # Incremented on each progress update. Used to detect concurrent updates of the same order.
+    version = Column(Integer, default=0, nullable=False)
+    created_time = Column(Integer, nullable=False)  # Stored as timestamp.
+    # Time the order was completed. None if the order isn't completed.
+    completed_time = Column(Integer, nullable=True)  # Stored as timestamp.
 
     items = relationship("OrderItem", back_populates="order", cascade="all, delete, delete-orphan")
 
-    def to_json(self) -> dict:
-        jsoned = Box()
-        jsoned.details = {}
-        jsoned.details.first_name = self.first_name
-        jsoned.details.last_name = self.last_name
-        jsoned.details.street = self.street
-        jsoned.details.city = self.city
-        jsoned.details.postal_code = self.postal_code
-        jsoned.details.order_progress = self.order_progress
+    __table_args__ = (
+        # Covers the lookup of changed orders by change sequence number including their progress, so
+        # that pages of changed orders can be read from the index alone.
+        Index(f"ix_{NAMES_OF_TABLES['order_table']}_change_seq", change_seq, order_progress),
+        # Only contains uncompleted orders. Queries need to use the exact same condition with a literal
+        # value (not a bound parameter) for SQLite to be able to use this index.
+        Index(
+            f"ix_{NAMES_OF_TABLES['order_table']}_open_change_seq",
+            change_seq,
+            sqlite_where=order_progress < ORDER_COMPLETED_PROGRESS,
+        ),
+        # Only contains uncompleted orders, ordered by delivery area. Used to group orders for dispatch.
+        Index(
+            f"ix_{NAMES_OF_TABLES['order_table']}_open_postal_code",
+            postal_code,
+            city,
+            sqlite_where=order_progress < ORDER_COMPLETED_PROGRESS,
+        ),
+        # Used to find completed orders which are old enough to be archived.
+        Index(f"ix_{NAMES_OF_TABLES['order_table']}_completed_time", completed_time),
+        # Archived orders are deleted from this table. Without AUTOINCREMENT SQLite would reuse their
+        # ids for new orders.
+        {"sqlite_autoincrement": True},
+    )
 
-        jsoned["items"] = [item.to_json() for item in self.items]
-        return jsoned.to_dict()
+    def to_json(self) -> dict:
+        jsoned = {
+            "order_id": self.order_id,
+            "details": {
+                "first_name": self.first_name,
+                "last_name": self.last_name,
+                "street": self.street,
+                "city": self.city,
+                "postal_code": self.postal_code,
+                "order_progress": self.order_progress,
+                "version": self.version,
+            },
+            "items": [item.to_json() for item in self.items],
+        }
+        return jsoned
 
 
 class OrderItem(Base):
@@ -124,13 +183,131 @@ class OrderItem(Base):
     order = relationship("Order", back_populates="items")
     item = relationship("Item")
 
+    __table_args__ = (
+        # Also covers the item and quantity, so that ordered items can be summed up from the index alone.
+        Index(f"ix_{NAMES_OF_TABLES['order_item_table']}_order_id", order_id, item_id, quantity),
+        # Archived ordered items are deleted from this table, see Order.
+        {"sqlite_autoincrement": True},
+    )
+
+    def to_json(self) -> dict:
+        jsoned = {
+            "order_id": self.order_id,
+            "item_id": self.item_id,
+            "unit_price": self.unit_price,
+            "quantity": self.quantity,
+        }
+        return jsoned
+
+
+class OrderChangeSequence(Base):
+    """Holds the last change sequence number assigned to an order.
+
+    The table only contains a single row. Each time orders are created or updated the value is
+    incremented in the same transaction and the new value is stored as change_seq of the orders.
+    This allows clients to only fetch orders which changed after a change sequence number they know.
+    """
+
+    __tablename__ = NAMES_OF_TABLES["order_change_sequence_table"]
+
+    sequence_id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+# Archive tables
+class ArchivedOrder(Base):
+    """An ArchivedOrder holds a completed order which was moved out of the order table.
+
+    Completed orders are archived after some time (see archive.py), so that the order table only
+    contains orders which are still relevant for delivery. The order keeps its id when archived.
+    """
+
+    __tablename__ = NAMES_OF_TABLES["archived_order_table"]
+
+    order_id = Column(Integer, primary_key=True, autoincrement=False)
+    first_name = Column(String, nullable=False)
+    last_name = Column(String, nullable=False)
+    street = Column(String, nullable=False)
+    city = Column(String, nullable=False)
+    postal_code = Column(String, nullable=False)
+    order_progress = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    created_time = Column(Integer, nullable=False)  # Stored as timestamp.
+    completed_time = Column(Integer, nullable=False)  # Stored as timestamp.
+    archived_time = Column(Integer, nullable=False)  # Stored as timestamp.
+
+    items = relationship("ArchivedOrderItem", back_populates="order", cascade="all, delete, delete-orphan")
+
     def to_json(self) -> dict:
-        jsoned = Box()
-        jsoned.order_id = self.order_id
-        jsoned.item_id = self.item_id
-        jsoned.unit_price = self.unit_price
-        jsoned.quantity = self.quantity
-        return jsoned.to_dict()
+        jsoned = {
+            "order_id": self.order_id,
+            "details": {
+                "first_name": self.first_name,
+                "last_name": self.last_name,
+                "street": self.street,
+                "city": self.city,
+                "postal_code": self.postal_code,
+                "order_progress": self.order_progress,
+                "version": self.version,
+                "created_time": self.created_time,
+                "completed_time": self.completed_time,
+            },
+            "items": [item.to_json() for item in self.items],
+        }
+        return jsoned
+
+
+class ArchivedOrderItem(Base):
+    """An ArchivedOrderItem holds an ordered item of an archived order."""
+
+    __tablename__ = NAMES_OF_TABLES["archived_order_item_table"]
+
+    order_item_id = Column(Integer, primary_key=True, autoincrement=False)
+    order_id = Column(ForeignKey(ArchivedOrder.order_id, ondelete="CASCADE"), nullable=False)
+    item_id = Column(ForeignKey(Item.item_id, ondelete="SET NULL"), nullable=True)
+    unit_price = Column(price_type)
+    quantity = Column(Integer)
+
+    order = relationship("ArchivedOrder", back_populates="items")
+
+    __table_args__ = (Index(f"ix_{NAMES_OF_TABLES['archived_order_item_table']}_order_id", order_id),)
+
+    def to_json(self) -> dict:
+        jsoned = {
+            "order_id": self.order_id,
+            "item_id": self.item_id,
+            "unit_price": self.unit_price,
+            "quantity": self.quantity,
+        }
+        return jsoned
+
+
+# Stats tables
+class HourlyOrderStats(Base):
+    """Counters of the orders placed in a time bucket (see stats.py).
+
+    Buckets in which no orders were placed don't exist.
+    """
+
+    __tablename__ = NAMES_OF_TABLES["hourly_order_stats_table"]
+
+    bucket_start = Column(Integer, primary_key=True, autoincrement=False)  # Stored as timestamp.
+    order_count = Column(Integer, nullable=False)
+    item_count = Column(Integer, nullable=False)  # Sum of the quantities of all ordered items.
+    revenue_cents = Column(Integer, nullable=False)
+
+
+class ItemSalesStats(Base):
+    """Counters of the sales of an item over all orders (see stats.py).
+
+    The item id isn't a foreign key, so that the counters of removed items are kept.
+    """
+
+    __tablename__ = NAMES_OF_TABLES["item_sales_stats_table"]
+
+    item_id = Column(Integer, primary_key=True, autoincrement=False)
+    quantity = Column(Integer, nullable=False)
+    revenue_cents = Column(Integer, nullable=False)
 
 
 # User tables
@@ -176,6 +353,8 @@ class RefreshToken(Base):
     )
     # Hashed refresh token which gets stored to the database.
     refresh_token_hash = Column(String, nullable=False, unique=True)
+    # Version of the scheme the token was hashed with (see TOKEN_HASH_VERSION_* in defaults.py).
+    hash_version = Column(Integer, nullable=False, default=TOKEN_HASH_VERSION_LEGACY, server_default="1")
     # Non hashed refresh token which gets sent back to the user.
     refresh_token: Optional[str] = None
     valid = Column(Boolean, nullable=False)
@@ -194,6 +373,14 @@ class RefreshToken(Base):
         "AccessToken", back_populates="refresh_token", cascade="all, delete, delete-orphan"
     )
 
+    __table_args__ = (
+        # Used to find out if tokens hashed with the legacy scheme are left.
+        Index(f"ix_{NAMES_OF_TABLES['refresh_token_table']}_hash_version", hash_version),
+        # Used by the token sweep to find successors and refresh tokens of descriptions.
+        Index(f"ix_{NAMES_OF_TABLES['refresh_token_table']}_originated_from", originated_from),
+        Index(f"ix_{NAMES_OF_TABLES['refresh_token_table']}_description_id", description_id),
+    )
+
     def response_json(self):
         """Generate json for providing information about a refresh token in a response."""
         # Beaware which information to leak in a response.
@@ -211,12 +398,23 @@ class AccessToken(Base):
     refresh_token_id = Column(ForeignKey(RefreshToken.refresh_token_id, ondelete="CASCADE"), nullable=False)
     # Hashed access token which gets stored to the database.
     access_token_hash = Column(String, nullable=False, unique=True)
+    # Version of the scheme the token was hashed with (see TOKEN_HASH_VERSION_* in defaults.py).
+    hash_version = Column(Integer, nullable=False, default=TOKEN_HASH_VERSION_LEGACY, server_default="1")
     # Non hashed access token which gets sent back to the user.
     access_token: Optional[str] = None
     expiration_time = Column(Integer, nullable=False)  # Stored as timestamp.
 
     refresh_token = relationship("RefreshToken", back_populates="access_tokens")
 
+    __table_args__ = (
+        # Used to find out if tokens hashed with the legacy scheme are left.
+        Index(f"ix_{NAMES_OF_TABLES['access_token_table']}_hash_version", hash_version),
+        # Used by the token sweep to find expired access tokens.
+        Index(f"ix_{NAMES_OF_TABLES['access_token_table']}_expiration_time", expiration_time),
+        # Used to delete access tokens together with their refresh token.
+        Index(f"ix_{NAMES_OF_TABLES['access_token_table']}_refresh_token_id", refresh_token_id),
+    )
+
     def response_json(self):
         """Generate json for providing information about a access token in a response."""
         # Beaware of which information to leak to the client.
@@ -236,7 +434,7 @@ def map_tables():
 
 
 def confirm_required_tables_exist():
-    """Check if all required tables exist in the database.
+    """Check if all required tables and their columns exist in the database.
 
     The table names specified in defaults.py are used to identify and thus check if
     tables exist.
@@ -246,4 +444,11 @@ def confirm_required_tables_exist():
 
     for required_table in required_tables:
         if required_table not in existing_tables:
-            raise RequiredTableMissing(required_table, config.db.path)
+            raise RequiredTableMissing(required_table, config.paths.database)
+
+    # Databases created by older versions of the backend lack columns which were added later.
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                raise RequiredColumnMissing(table.name, column.name, config.paths.database)
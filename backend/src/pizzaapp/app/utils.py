@@ -3,9 +3,8 @@
 Mostly contains generic functions.
 """
 
-from collections import namedtuple
 from threading import Lock
-from typing import Optional, TypeVar
+from typing import Any, Optional, TypeVar
 
 from box import Box
 from flask import make_response, Request
@@ -15,7 +14,9 @@ from werkzeug.exceptions import default_exceptions
 from pizzaapp.app.defaults import APP_ERROR_CODES
 
 
-def error_response(error_code: int, app_error_key: Optional[int] = None) -> dict:
+def error_response(
+    error_code: int, app_error_key: Optional[int] = None, extra: Optional[dict] = None
+) -> dict:
     """Generates an JSON error response a certain error code.
 
     Only run this function if a Flask request context exists.
@@ -23,6 +24,7 @@ def error_response(error_code: int, app_error_key: Optional[int] = None) -> dict
     :param error_code: HTTP error code.
     :param app_error_code: An optional application specific error code. See defaults.py
         file for explanation.
+    :param extra: Optional additional information added to the error section of the body.
     """
     error = default_exceptions[error_code]()
     body = Box()  # Response body
@@ -37,6 +39,8 @@ def error_response(error_code: int, app_error_key: Optional[int] = None) -> dict
         using_default_app_error = True
         body.error.app_error_key = "error_not_mapped"
     body.error.app_error_code = APP_ERROR_CODES[body.error.app_error_key]
+    if extra is not None:
+        body.error.update(extra)
 
     if not using_default_app_error:
         # Flask will output the HTTP error code, so we just need to log the app error code.
@@ -47,11 +51,12 @@ def error_response(error_code: int, app_error_key: Optional[int] = None) -> dict
     return response, error_code
 
 
-def get_body_box(request: Request) -> Optional[Box]:
-    """Get the request body as a Box object if the body is valid JSON,
+def get_body_json(request: Request) -> Optional[Any]:
+    """Get the parsed request body if the body is valid JSON.
 
-    :returns: Box object containing the request body if the body is valid JSON,
-        none if it's not.
+    The body still needs to be validated, see schema.py.
+
+    :returns: The parsed request body if the body is valid JSON, none if it's not.
     """
     body_json = request.get_json(silent=True, cache=False)
     if body_json is None:
@@ -59,28 +64,25 @@ def get_body_box(request: Request) -> Optional[Box]:
             f'Can\'t get json because the request body is empty or has an invalid format: "{repr(request.data)}".'
         )
         return None
-    body_box = Box(body_json)
-    return body_box
-
-
-Field = namedtuple("Field", ["name", "type_"])
+    return body_json
 
 
-def check_fields(dict_: Box, fields: list[Field]) -> bool:
-    """Check the parsed dict if it contains the field names and has the correct field types.
+def get_bool_arg(request: Request, name: str) -> Optional[bool]:
+    """Get a boolean query string argument of a request.
 
-    Function only checks keys of the dictionary which are in the root depth.
+    :returns: The boolean value of the argument, false if the argument isn't set, none if
+        the argument has a value which can't be interpreted as boolean.
     """
-
-    for field in fields:
-        field_value = dict_.get(field[0])
-        if field_value is None:
-            logger.debug(f"Field '{field[0]}' not contained: {dict_}.")
-            return False
-        # if not isinstance(field_value, field.type_):
-        #     logger.debug(f"Field '{field[0]}' is not of required type {str(field[1])}: {dict_}.")
-        #     return False
-    return True
+    value = request.args.get(name)
+    if value is None:
+        return False
+    condition = value.lower()
+    if condition in ("true", "1", "yes"):
+        return True
+    if condition in ("false", "0", "no", ""):
+        return False
+    logger.debug(f"Query argument '{name}' has a non boolean value: {value}.")
+    return None
 
 
 QueryRowType = TypeVar("RowType")
@@ -9,6 +9,7 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
 from pizzaapp.app import Base
+from pizzaapp.app.catalog import bump_catalog_version, record_catalog_changes
 from pizzaapp.app.defaults import NAMES_OF_TABLES
 from pizzaapp.app.tables import Category, Item, ItemPrice, ItemSpeciality
 
@@ -118,10 +119,19 @@ def map_base_data(data: dict):
 
 
 def insert_mapped_base_data(engine: Engine, data: list):
-    """Insert a set of rows containing one or multiple different table object row types."""
+    """Insert a set of rows containing one or multiple different table object row types.
+
+    Also increments the catalog version so that running backends reload the catalog and
+    records all inserted items in the catalog change log.
+    """
     with Session(engine, future=True) as session:
+        changed_item_ids = []
         for item in data:
             session.add(item)
+            if isinstance(item, (Item, ItemPrice, ItemSpeciality)):
+                changed_item_ids.append(item.item_id)
+        version = bump_catalog_version(session)
+        record_catalog_changes(session, version, changed_item_ids)
         session.commit()
 
 
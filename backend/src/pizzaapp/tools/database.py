@@ -3,7 +3,8 @@
 """Simple CLI to manage the pizzaapp database on your machine.
 
 The CLI is controlled by command line arguments.
-It does create all tables, insert predefined data and remove tables.
+It does create all tables, migrate tables of older versions, insert predefined data, archive
+completed orders, rebuild order stats, delete expired tokens and remove tables.
 Base data or predefined data is data read from CSV files. Examples are items and their prices.
 """
 
@@ -15,8 +16,11 @@ from rich.console import Console
 from rich.prompt import Confirm
 
 from pizzaapp.app import config, engine, registry
+from pizzaapp.app.archive import archive_orders
+from pizzaapp.app.stats import rebuild_stats
+from pizzaapp.app.sweep import sweep_tokens
 from pizzaapp.tools.base_data import base_data_populate
-from pizzaapp.tools.tables import create_tables, delete_tables
+from pizzaapp.tools.tables import create_tables, delete_tables, migrate_tables
 
 console = Console(highlight=True)
 
@@ -36,6 +40,13 @@ def get_parser():
         default=False,
         help="create pizzaapp tables",
     )
+    parser.add_argument(
+        "-m",
+        "--migrate",
+        action="store_true",
+        default=False,
+        help="update pizzaapp tables created by an older version",
+    )
     parser.add_argument(
         "-i",
         "--insert",
@@ -43,6 +54,29 @@ def get_parser():
         default=False,
         help="insert pizzaapp base data into tables",
     )
+    parser.add_argument(
+        "-a",
+        "--archive",
+        action="store_true",
+        default=False,
+        help="move old completed orders to the archive tables",
+    )
+    parser.add_argument(
+        "-s",
+        "--rebuild-stats",
+        action="store_true",
+        default=False,
+        help="recompute order stats from all orders",
+        dest="rebuild_stats",
+    )
+    parser.add_argument(
+        "-t",
+        "--sweep-tokens",
+        action="store_true",
+        default=False,
+        help="delete expired access tokens and old replaced refresh tokens",
+        dest="sweep_tokens",
+    )
     parser.add_argument(
         "-d",
         "--delete",
@@ -59,12 +93,50 @@ def cmd_create_tables(metadata: MetaData):
     console.print("[green bold]Created PizzaApp tables in database.[/green bold]")
 
 
+def cmd_migrate_tables(metadata: MetaData):
+    """Handle CLI command to update tables created by an older version."""
+    changes = migrate_tables(metadata)
+    for change in changes:
+        console.print(change)
+    console.print("[green bold]Migrated PizzaApp tables.[/green bold]")
+
+
 def cmd_insert_base_data(engine: Engine):
     """Handle CLI command to insert base data."""
     base_data_populate(engine)
     console.print("[green bold]Inserted PizzaApp base data.[/green bold]")
 
 
+def cmd_archive_orders(engine: Engine):
+    """Handle CLI command to archive old completed orders.
+
+    The maximum age and batch size are read from the config.
+    """
+    archived_count = archive_orders(engine, config.archive.max_age_hours * 3600, config.archive.batch_size)
+    console.print(f"[green bold]Archived {archived_count} completed orders.[/green bold]")
+
+
+def cmd_rebuild_stats(engine: Engine):
+    """Handle CLI command to recompute the order stats from all orders."""
+    with engine.begin() as connection:
+        rebuild_stats(connection)
+    console.print("[green bold]Rebuilt PizzaApp order stats.[/green bold]")
+
+
+def cmd_sweep_tokens(engine: Engine):
+    """Handle CLI command to delete tokens which aren't needed anymore.
+
+    The retention time of replaced refresh tokens and the batch size are read from the config.
+    """
+    result = sweep_tokens(
+        engine, config.token_sweep.refresh_token_retention_days * 86400, config.token_sweep.batch_size
+    )
+    console.print(
+        f"[green bold]Deleted {result.access_tokens} access tokens, {result.refresh_tokens} refresh tokens "
+        f"and {result.descriptions} refresh token descriptions.[/green bold]"
+    )
+
+
 def cmd_delete_tables(metadata: MetaData):
     """Handle CLI command to delete all projects tables.
 
@@ -88,8 +160,16 @@ def main():
         console.print(f"[bold blue]Database path:[/bold blue] {config.db.path}")
     elif args.create is True:
         cmd_create_tables(metadata)
+    elif args.migrate is True:
+        cmd_migrate_tables(metadata)
     elif args.insert is True:
         cmd_insert_base_data(engine)
+    elif args.archive is True:
+        cmd_archive_orders(engine)
+    elif args.rebuild_stats is True:
+        cmd_rebuild_stats(engine)
+    elif args.sweep_tokens is True:
+        cmd_sweep_tokens(engine)
     elif args.delete is True:
         cmd_delete_tables(metadata)
     else:
@@ -1,6 +1,32 @@
 """Commands to add and modify the projects database tables."""
 
-from sqlalchemy import MetaData
+from sqlalchemy import inspect, MetaData, Table
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn, CreateTable
+
+from pizzaapp.app.defaults import NAMES_OF_TABLES, ORDER_COMPLETED_PROGRESS
+from pizzaapp.app.order import ORDER_CHANGE_SEQUENCE_ID
+
+_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# Values of columns which were added to existing tables but need a value and have no server default.
+# They can't be added with ALTER TABLE, instead the table is rebuilt and the values are computed from
+# each existing row with these SQL expressions.
+_COLUMN_BACKFILLS = {
+    NAMES_OF_TABLES["order_table"]: {
+        # Existing orders are treated as if they were changed in the order of their ids.
+        "change_seq": "order_id",
+        "version": "0",
+        "created_time": _NOW,
+        "completed_time": f"CASE WHEN order_progress >= {ORDER_COMPLETED_PROGRESS} THEN {_NOW} END",
+    },
+}
+
+# Tables whose ids must not be reused and the archive tables which hold their deleted rows.
+_ARCHIVED_IDS = {
+    NAMES_OF_TABLES["order_table"]: (NAMES_OF_TABLES["archived_order_table"], "order_id"),
+    NAMES_OF_TABLES["order_item_table"]: (NAMES_OF_TABLES["archived_order_item_table"], "order_item_id"),
+}
 
 
 def create_tables(metadata: MetaData):
@@ -12,6 +38,168 @@ def create_tables(metadata: MetaData):
     metadata.create_all(checkfirst=True)
 
 
+def _needs_rebuild(connection: Connection, table: Table, existing_columns: set[str]) -> bool:
+    """Check if a table can only be migrated by rebuilding it.
+
+    This is the case if it should use AUTOINCREMENT but doesn't or lacks columns which need a value.
+    """
+    if table.dialect_options["sqlite"]["autoincrement"]:
+        stmt = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?"
+        table_sql = connection.exec_driver_sql(stmt, (table.name,)).scalar_one()
+        if "AUTOINCREMENT" not in table_sql.upper():
+            return True
+    return any(
+        column.name not in existing_columns and not column.nullable and column.server_default is None
+        for column in table.columns
+    )
+
+
+def _rebuild_table(connection: Connection, table: Table, existing_columns: set[str]):
+    """Recreate a table with its current definition and copy its rows.
+
+    Follows the procedure of the SQLite documentation to make other kinds of table schema changes.
+    Foreign key checks must be disabled, otherwise dropping the old table would delete rows
+    referring to it. The indexes of the table are dropped and need to be created again.
+    """
+    backfills = _COLUMN_BACKFILLS.get(table.name, {})
+    column_names = []
+    column_values = []
+    for column in table.columns:
+        if column.name in existing_columns:
+            column_names.append(column.name)
+            column_values.append(column.name)
+        elif column.name in backfills:
+            column_names.append(column.name)
+            column_values.append(backfills[column.name])
+        elif not column.nullable and column.server_default is None:
+            raise ValueError(f"No value for the new column {table.name}.{column.name}.")
+
+    preparer = connection.dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    new_table_name = preparer.quote(f"_migrate_{table.name}")
+    create_sql = str(CreateTable(table).compile(dialect=connection.dialect))
+    create_sql = create_sql.replace(f"CREATE TABLE {table_name} (", f"CREATE TABLE {new_table_name} (", 1)
+    quoted_names = ", ".join(preparer.quote(name) for name in column_names)
+
+    connection.exec_driver_sql(create_sql)
+    connection.exec_driver_sql(
+        f"INSERT INTO {new_table_name} ({quoted_names}) SELECT {', '.join(column_values)} FROM {table_name}"
+    )
+    connection.exec_driver_sql(f"DROP TABLE {table_name}")
+    connection.exec_driver_sql(f"ALTER TABLE {new_table_name} RENAME TO {table_name}")
+
+    if table.name == NAMES_OF_TABLES["order_table"]:
+        # Tables migrated earlier might have got the completed time as nullable column without a value.
+        connection.exec_driver_sql(
+            f"UPDATE {table_name} SET completed_time = {_NOW} "
+            f"WHERE order_progress >= {ORDER_COMPLETED_PROGRESS} AND completed_time IS NULL"
+        )
+        # New orders need change sequence numbers after the ones of the existing orders.
+        connection.exec_driver_sql(
+            f"INSERT OR REPLACE INTO {NAMES_OF_TABLES['order_change_sequence_table']} (sequence_id, value) "
+            f"SELECT ?, COALESCE(MAX(change_seq), 0) FROM {table_name}",
+            (ORDER_CHANGE_SEQUENCE_ID,),
+        )
+
+
+def _reserve_archived_ids(connection: Connection, table: Table):
+    """Make sure that AUTOINCREMENT never assigns ids of rows which were moved to the archive."""
+    archive_table_name, id_column = _ARCHIVED_IDS[table.name]
+    max_archived_id = connection.exec_driver_sql(
+        f"SELECT COALESCE(MAX({id_column}), 0) FROM {archive_table_name}"
+    ).scalar_one()
+    if max_archived_id == 0:
+        return
+    stmt = "SELECT seq FROM sqlite_sequence WHERE name = ?"
+    sequence = connection.exec_driver_sql(stmt, (table.name,)).scalar_one_or_none()
+    if sequence is None:
+        stmt = "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)"
+        connection.exec_driver_sql(stmt, (table.name, max_archived_id))
+    elif sequence < max_archived_id:
+        stmt = "UPDATE sqlite_sequence SET seq = ? WHERE name = ?"
+        connection.exec_driver_sql(stmt, (max_archived_id, table.name))
+
+
+def _rebuild_tables(metadata: MetaData) -> list[str]:
+    """Rebuild all tables which can't be migrated otherwise in one transaction.
+
+    :returns: Descriptions of the changes which were made.
+    """
+    changes = []
+    # The driver would otherwise commit before each DDL statement. Begin and commit explicitly instead.
+    with metadata.bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        connection.exec_driver_sql("BEGIN")
+        try:
+            inspector = inspect(connection)
+            for table in metadata.sorted_tables:
+                existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+                if not _needs_rebuild(connection, table, existing_columns):
+                    continue
+                _rebuild_table(connection, table, existing_columns)
+                changes.append(f"Rebuilt table {table.name}.")
+            for table in metadata.sorted_tables:
+                if table.name in _ARCHIVED_IDS:
+                    _reserve_archived_ids(connection, table)
+            if connection.exec_driver_sql("PRAGMA foreign_key_check").first() is not None:
+                raise ValueError("Rebuilt tables contain rows with invalid foreign keys.")
+        except BaseException:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+        else:
+            connection.exec_driver_sql("COMMIT")
+        finally:
+            connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+    return changes
+
+
+def migrate_tables(metadata: MetaData) -> list[str]:
+    """Update tables created by an older version of the backend to the current tables.
+
+    Creates missing tables, adds missing columns and creates missing indexes. Columns which are nullable
+    or have a server default are added with ALTER TABLE. Tables which lack other columns or should use
+    AUTOINCREMENT are rebuilt (see _COLUMN_BACKFILLS). Running the migration again doesn't change anything.
+
+    :returns: Descriptions of the changes which were made and of changes which couldn't be made.
+    """
+    engine = metadata.bind
+    existing_tables = set(inspect(engine).get_table_names())
+    changes = [
+        f"Created table {table.name}."
+        for table in metadata.sorted_tables
+        if table.name not in existing_tables
+    ]
+    metadata.create_all(checkfirst=True)
+    changes.extend(_rebuild_tables(metadata))
+
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            missing_columns = set()
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    missing_columns.add(column.name)
+                    changes.append(f"Can't add column {table.name}.{column.name}, it needs a value.")
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {column_ddl}')
+                changes.append(f"Added column {table.name}.{column.name}.")
+
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if any(column.name in missing_columns for column in index.columns):
+                    changes.append(f"Can't create index {index.name}, a column of it is missing.")
+                    continue
+                index.create(connection)
+                changes.append(f"Created index {index.name}.")
+    return changes
+
+
 def delete_tables(metadata: MetaData):
     """Delete all projects tables.
 
@@ -1,10 +1,18 @@
-import pytest
+import os
+import tempfile
 
-from sqlalchemy import MetaData
+# Importing pizzaapp reads the config and connects to the database. Point it to a temporary home
+# directory, so that tests don't touch the config and database of the user running them.
+os.environ["HOME"] = tempfile.mkdtemp(prefix="pizzaapp-tests-")
 
-from src.pizzaapp.database import connect
-from src.pizzaapp.config import read_config
-from src.tools.base_data import base_data_populate
+import pytest  # noqa: E402
+
+from box import Box  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+from pizzaapp.app import registry  # noqa: E402
+from pizzaapp.app.config import read_config  # noqa: E402
+from pizzaapp.app.database import connect  # noqa: E402
 
 
 @pytest.fixture(scope="session")
@@ -13,17 +21,10 @@ def get_config() -> Box:
     return config
 
 
-@pytest.fixture(scope="session")
-def mock_db_manager() -> DatabaseManager:
-    mock_engine = connect(":memory:")
-    metadata = MetaData(mock_engine)
-    base_data_populate(mock_engine)
-    yield db_manager
-    mock_engine.dispose()
-
-
-@pytest.fixture(scope="session")
-def real_db_manager(config) -> DatabaseManager:
-    db_manager = DatabaseManager(config.db.path)
-    yield db_manager
-    db_manager.engine.dispose()
+@pytest.fixture
+def memory_engine() -> Engine:
+    """Engine of an in-memory database containing all PizzaApp tables."""
+    engine = connect(":memory:", False)
+    registry.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
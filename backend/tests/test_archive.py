@@ -0,0 +1,50 @@
+from decimal import Decimal
+
+import arrow
+
+from sqlalchemy import select, update
+
+from pizzaapp.app import defaults
+from pizzaapp.app.archive import archive_orders
+from pizzaapp.app.order import insert_orders
+from pizzaapp.app.tables import ArchivedOrder, Order, OrderItem
+
+
+def _new_order(name: str) -> Order:
+    order = Order(first_name=name, last_name="Test", street="Street 1", city="City", postal_code="12345")
+    order.items.append(OrderItem(item_id=None, unit_price=Decimal("5.00"), quantity=1))
+    return order
+
+
+def _complete_orders(engine, order_ids: list[int]):
+    with engine.begin() as connection:
+        connection.execute(
+            update(Order.__table__)
+            .where(Order.__table__.c.order_id.in_(order_ids))
+            .values(
+                order_progress=defaults.ORDER_COMPLETED_PROGRESS, completed_time=arrow.now().int_timestamp
+            )
+        )
+
+
+def test_archived_order_ids_are_not_reused(memory_engine):
+    with memory_engine.begin() as connection:
+        order_ids = insert_orders(connection, [_new_order(str(index)) for index in range(5)])
+    # Archive the orders with the highest ids, so that SQLite would hand them out again.
+    _complete_orders(memory_engine, order_ids[-2:])
+    assert archive_orders(memory_engine, 0, 10) == 2
+
+    with memory_engine.begin() as connection:
+        (new_order_id,) = insert_orders(connection, [_new_order("new")])
+    assert new_order_id > order_ids[-1]
+
+    with memory_engine.connect() as connection:
+        item_order_ids = connection.execute(select(OrderItem.__table__.c.order_id)).scalars().all()
+    assert new_order_id in item_order_ids
+
+    # Archiving the new order must not collide with the already archived orders.
+    _complete_orders(memory_engine, [new_order_id])
+    assert archive_orders(memory_engine, 0, 10) == 1
+    with memory_engine.connect() as connection:
+        archived_ids = connection.execute(select(ArchivedOrder.__table__.c.order_id)).scalars().all()
+    assert sorted(archived_ids) == order_ids[-2:] + [new_order_id]
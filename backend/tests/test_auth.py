@@ -0,0 +1,118 @@
+from threading import Lock
+
+import arrow
+import pytest
+
+from sqlalchemy.orm import Session
+
+from pizzaapp.app import auth, config
+from pizzaapp.app.auth import AccessTokenRevocations, SignedAccessToken
+from pizzaapp.app.tables import DeliveryUser
+
+KEY = b"k" * 32
+
+
+@pytest.fixture
+def signed_access_tokens(monkeypatch):
+    monkeypatch.setitem(config.security, "signed_access_tokens", True)
+    monkeypatch.setitem(config.security, "token_pepper", "test pepper")
+
+
+def _login(session: Session, user_id: int) -> auth.TokenInfo:
+    refresh_token = auth.gen_refresh_token(user_id=user_id, device_description="test")
+    token_info = auth.TokenInfo(refresh_token, auth.gen_access_token(user_id, refresh_token))
+    lock = Lock()
+    lock.acquire()
+    auth.store_token_info(session, lock, token_info)
+    return token_info
+
+
+def _refresh(session: Session, user_id: int, token_info: auth.TokenInfo) -> auth.TokenInfo:
+    old_refresh_token = token_info.refresh_token
+    refresh_token = auth.gen_refresh_token(
+        originated_from=old_refresh_token.refresh_token_id,
+        refers_description=old_refresh_token.description_id,
+    )
+    new_token_info = auth.TokenInfo(refresh_token, auth.gen_access_token(user_id, refresh_token))
+    lock = Lock()
+    lock.acquire()
+    auth.store_refreshed_token_info(session, lock, new_token_info, old_refresh_token)
+    return new_token_info
+
+
+@pytest.fixture
+def session(memory_engine):
+    with Session(memory_engine) as session:
+        yield session
+
+
+@pytest.fixture
+def user_id(session) -> int:
+    delivery_user = DeliveryUser(username="max", pw_hash="x" * 60, date_created=0)
+    session.add(delivery_user)
+    session.commit()
+    return delivery_user.user_id
+
+
+def test_signed_access_token_round_trip():
+    token = SignedAccessToken(7, 2**64 - 1, 1_700_000_000)
+    assert SignedAccessToken.from_hex(KEY, token.to_hex(KEY)) == token
+
+
+def test_tampered_signed_access_tokens_are_rejected():
+    token_bytes = bytearray.fromhex(SignedAccessToken(7, 12345, 1_700_000_000).to_hex(KEY))
+    assert SignedAccessToken.from_hex(b"o" * 32, token_bytes.hex()) is None
+
+    tampered_mac = bytearray(token_bytes)
+    tampered_mac[-1] ^= 1
+    assert SignedAccessToken.from_hex(KEY, tampered_mac.hex()) is None
+
+    # Changes the user id.
+    tampered_fields = bytearray(token_bytes)
+    tampered_fields[4] ^= 1
+    assert SignedAccessToken.from_hex(KEY, tampered_fields.hex()) is None
+
+    assert SignedAccessToken.from_hex(KEY, token_bytes[:-1].hex()) is None
+    assert SignedAccessToken.from_hex(KEY, (token_bytes + b"\0").hex()) is None
+
+
+def test_revocations_only_affect_their_refresh_token():
+    revocations = AccessTokenRevocations()
+    token = SignedAccessToken(7, 1, 1_700_000_000)
+    other_token = SignedAccessToken(7, 2, 1_700_000_000)
+    revocations.revoke_refresh_token(1)
+    assert revocations.is_revoked(token)
+    assert not revocations.is_revoked(other_token)
+
+
+def test_expired_signed_access_token_is_rejected(signed_access_tokens, session):
+    key = auth.get_access_token_signing_key()
+    expired = SignedAccessToken(1, 1, arrow.now().int_timestamp - 1).to_hex(key)
+    valid = SignedAccessToken(1, 1, arrow.now().int_timestamp + 60).to_hex(key)
+    assert not auth.check_access_token(session, expired)
+    assert auth.check_access_token(session, valid)
+
+
+def test_refresh_revokes_previous_signed_access_token(signed_access_tokens, session, user_id):
+    token_info = _login(session, user_id)
+    access_token = token_info.access_token.access_token
+    assert SignedAccessToken.from_hex(auth.get_access_token_signing_key(), access_token) is not None
+    assert auth.check_access_token(session, access_token)
+
+    new_token_info = _refresh(session, user_id, token_info)
+    assert not auth.check_access_token(session, access_token)
+    assert auth.check_access_token(session, new_token_info.access_token.access_token)
+
+
+def test_expire_user_access_revokes_signed_access_tokens(signed_access_tokens, session, user_id):
+    first_access_token = _login(session, user_id).access_token.access_token
+    second_access_token = _login(session, user_id).access_token.access_token
+    assert auth.check_access_token(session, first_access_token)
+    assert auth.check_access_token(session, second_access_token)
+
+    auth.expire_user_access(session, user_id)
+    assert not auth.check_access_token(session, first_access_token)
+    assert not auth.check_access_token(session, second_access_token)
+
+    # Logging in again isn't affected by the revocations.
+    assert auth.check_access_token(session, _login(session, user_id).access_token.access_token)
@@ -0,0 +1,37 @@
+from concurrent.futures import Future
+from decimal import Decimal
+
+import pytest
+
+from pizzaapp.app.ingest import OrderIngestor, PendingOrder
+from pizzaapp.app.tables import Order, OrderItem
+
+
+def _new_order() -> Order:
+    order = Order(first_name="Max", last_name="Test", street="Street 1", city="City", postal_code="12345")
+    order.items.append(OrderItem(item_id=None, unit_price=Decimal("5.00"), quantity=1))
+    return order
+
+
+def test_failed_group_fails_its_futures(memory_engine):
+    ingestor = OrderIngestor(memory_engine, batch_size=10, batch_window=0)
+    # Not an order, inserting it raises an error which isn't raised by SQLAlchemy.
+    failing = PendingOrder(object(), Future())
+    ingestor.insert_batch([failing])
+    with pytest.raises(AttributeError):
+        failing.future.result(timeout=0)
+
+    future = ingestor.submit(_new_order())
+    ingestor.insert_batch(ingestor.next_batch(timeout=0))
+    assert future.result(timeout=0) > 0
+
+
+def test_orders_are_resolved_if_notification_fails(memory_engine):
+    def on_insert():
+        raise RuntimeError("notification failed")
+
+    ingestor = OrderIngestor(memory_engine, batch_size=10, batch_window=0.1, on_insert=on_insert)
+    futures = [ingestor.submit(_new_order()) for _ in range(3)]
+    ingestor.insert_batch(ingestor.next_batch(timeout=0))
+    order_ids = [future.result(timeout=0) for future in futures]
+    assert order_ids == sorted(set(order_ids))
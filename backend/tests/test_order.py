@@ -0,0 +1,149 @@
+import base64
+import json
+
+from decimal import Decimal
+
+import pytest
+
+from sqlalchemy import select
+
+from pizzaapp.app import defaults
+from pizzaapp.app.order import (
+    apply_progress_updates,
+    generate_changed_orders_json,
+    insert_order_batch,
+    insert_orders,
+    OrderPageToken,
+    ProgressUpdate,
+)
+from pizzaapp.app.tables import Order, OrderItem
+
+
+def _new_order(name: str, quantity: int = 1) -> Order:
+    order = Order(first_name=name, last_name="Test", street="Street 1", city="City", postal_code="12345")
+    order.items.append(OrderItem(item_id=None, unit_price=Decimal("5.00"), quantity=quantity))
+    return order
+
+
+def test_batch_order_ids_match_their_orders(memory_engine):
+    new_orders = [_new_order("a", 1), None, _new_order("b", 2), None, None, _new_order("c", 3)]
+    with memory_engine.begin() as connection:
+        results = insert_order_batch(connection, new_orders)
+
+    assert len(results) == len(new_orders)
+    for new_order, result in zip(new_orders, results):
+        if new_order is None:
+            assert result["error"]["app_error_key"] == "order_not_valid"
+            continue
+        with memory_engine.connect() as connection:
+            first_name = connection.execute(
+                select(Order.first_name).where(Order.order_id == result["order_id"])
+            ).scalar_one()
+            quantities = (
+                connection.execute(select(OrderItem.quantity).where(OrderItem.order_id == result["order_id"]))
+                .scalars()
+                .all()
+            )
+        assert first_name == new_order.first_name
+        assert quantities == [new_order.items[0].quantity]
+
+
+def test_batch_of_invalid_orders_inserts_nothing(memory_engine):
+    with memory_engine.begin() as connection:
+        results = insert_order_batch(connection, [None, None])
+    assert [result["error"]["app_error_key"] for result in results] == ["order_not_valid"] * 2
+    with memory_engine.connect() as connection:
+        assert connection.execute(select(Order.order_id)).first() is None
+
+
+@pytest.fixture
+def changed_orders(memory_engine):
+    """Orders whose open and completed changes alternate.
+
+    Changes by change sequence number: open 3, open 5, completed 2, completed 4, open 1.
+    """
+    with memory_engine.begin() as connection:
+        order_ids = insert_orders(connection, [_new_order(str(index)) for index in range(1, 6)])
+    with memory_engine.begin() as connection:
+        completed = defaults.ORDER_COMPLETED_PROGRESS
+        updates = [
+            ProgressUpdate(order_ids[1], completed, None),
+            ProgressUpdate(order_ids[3], completed, None),
+        ]
+        apply_progress_updates(connection, updates)
+    with memory_engine.begin() as connection:
+        apply_progress_updates(connection, [ProgressUpdate(order_ids[0], 10, None)])
+    return order_ids
+
+
+def _get_pages(engine, include_completed: bool, limit: int) -> list[dict]:
+    pages = []
+    page = OrderPageToken(0, include_completed)
+    while True:
+        response = json.loads("".join(generate_changed_orders_json(engine, page, limit)))
+        pages.append(response)
+        if response["next_page_token"] is None:
+            return pages
+        page = OrderPageToken.decode(response["next_page_token"])
+
+
+def _page_changes(page: dict) -> list:
+    return [order["order_id"] for order in page["orders"]] + [
+        ("completed", order_id) for order_id in page["completed_order_ids"]
+    ]
+
+
+def test_changed_order_pages_merge_open_and_completed_orders(memory_engine, changed_orders):
+    id_1, id_2, id_3, id_4, id_5 = changed_orders
+    pages = _get_pages(memory_engine, include_completed=True, limit=3)
+    assert [_page_changes(page) for page in pages] == [
+        [id_3, id_5, ("completed", id_2)],
+        [id_1, ("completed", id_4)],
+    ]
+    assert pages[0]["cursor"] < pages[1]["cursor"]
+
+    pages = _get_pages(memory_engine, include_completed=True, limit=2)
+    assert [_page_changes(page) for page in pages] == [
+        [id_3, id_5],
+        [("completed", id_2), ("completed", id_4)],
+        [id_1],
+    ]
+
+
+def test_changed_order_pages_without_completed_orders(memory_engine, changed_orders):
+    id_1, _, id_3, _, id_5 = changed_orders
+    pages = _get_pages(memory_engine, include_completed=False, limit=2)
+    assert [_page_changes(page) for page in pages] == [[id_3, id_5], [id_1]]
+
+
+def test_last_page_has_no_next_page(memory_engine, changed_orders):
+    # The page holds exactly all five changes, only three of them are open orders.
+    pages = _get_pages(memory_engine, include_completed=True, limit=5)
+    assert len(pages) == 1
+    pages = _get_pages(memory_engine, include_completed=True, limit=4)
+    assert len(pages) == 2
+
+
+def test_page_token_round_trip():
+    page = OrderPageToken(42, True)
+    assert OrderPageToken.decode(page.encode()) == page
+
+
+@pytest.mark.parametrize(
+    "token",
+    [
+        "not a token",
+        "",
+        base64.urlsafe_b64encode(b"[-1, true]").decode(),
+        base64.urlsafe_b64encode(b"[1, 1]").decode(),
+        base64.urlsafe_b64encode(b"[true, true]").decode(),
+        base64.urlsafe_b64encode(b'["1", false]').decode(),
+        base64.urlsafe_b64encode(b"[1]").decode(),
+        base64.urlsafe_b64encode(b"[1, false, 2]").decode(),
+        base64.urlsafe_b64encode(b'{"after": 1}').decode(),
+        base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+        "\u00e4",
+    ],
+)
+def test_tampered_page_tokens_are_rejected(token):
+    assert OrderPageToken.decode(token) is None
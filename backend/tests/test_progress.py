@@ -0,0 +1,50 @@
+from decimal import Decimal
+
+from pizzaapp.app.cache import BoundedCache
+from pizzaapp.app.order import (
+    apply_progress_updates,
+    get_progress,
+    insert_orders,
+    ProgressUpdate,
+    publish_progress_updates,
+)
+from pizzaapp.app.progress_hub import ProgressHub
+from pizzaapp.app.tables import Order, OrderItem
+
+
+def _insert_order(engine) -> int:
+    order = Order(first_name="Max", last_name="Test", street="Street 1", city="City", postal_code="12345")
+    order.items.append(OrderItem(item_id=None, unit_price=Decimal("5.00"), quantity=1))
+    with engine.begin() as connection:
+        (order_id,) = insert_orders(connection, [order])
+    return order_id
+
+
+def test_progress_cache_keeps_newest_version(memory_engine):
+    order_id = _insert_order(memory_engine)
+    progress_cache = BoundedCache(10)
+    progress_hub = ProgressHub(1)
+
+    with memory_engine.begin() as connection:
+        first_results = apply_progress_updates(connection, [ProgressUpdate(order_id, 1, None)])
+    with memory_engine.begin() as connection:
+        second_results = apply_progress_updates(connection, [ProgressUpdate(order_id, 2, None)])
+
+    # The request which committed first publishes its update last.
+    publish_progress_updates(second_results, progress_hub, progress_cache)
+    publish_progress_updates(first_results, progress_hub, progress_cache)
+    with memory_engine.connect() as connection:
+        assert get_progress(connection, order_id, progress_cache) == 2
+
+
+def test_progress_read_from_database_does_not_replace_newer_progress(memory_engine):
+    order_id = _insert_order(memory_engine)
+    progress_cache = BoundedCache(10)
+    with memory_engine.begin() as connection:
+        results = apply_progress_updates(connection, [ProgressUpdate(order_id, 1, None)])
+
+    # A request read the progress before the update was committed and caches it after the update.
+    progress_cache.set_versioned(order_id, results[0].version, results[0].order_progress)
+    progress_cache.set_versioned(order_id, results[0].version - 1, 0)
+    with memory_engine.connect() as connection:
+        assert get_progress(connection, order_id, progress_cache) == 1
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from pizzaapp.app import schema
+from pizzaapp.app.exceptions import SchemaViolation
+
+
+@pytest.mark.parametrize("value", [True, False, 1.0, "1", None])
+def test_integer_rejects_other_types(value):
+    assert schema.Validator(schema.Integer()).validate(value) is None
+
+
+@pytest.mark.parametrize("value", [True, False, "1.5", None])
+def test_number_rejects_other_types(value):
+    assert schema.Validator(schema.Number()).validate(value) is None
+
+
+@pytest.mark.parametrize("raw_value", ["NaN", "Infinity", "-Infinity", "1e400"])
+def test_number_rejects_non_finite_numbers(raw_value):
+    # The JSON parser accepts these and returns non-finite floats.
+    value = json.loads(raw_value)
+    assert schema.Validator(schema.Number()).validate(value) is None
+
+
+def test_ranges_are_checked():
+    validator = schema.Validator(schema.Integer(minimum=1, maximum=3))
+    assert [validator.validate(value) for value in (0, 1, 3, 4)] == [None, 1, 3, None]
+    validator = schema.Validator(schema.Number(minimum=0))
+    assert [validator.validate(value) for value in (-0.5, 0, 2.5)] == [None, 0, 2.5]
+
+
+def test_nullable_fields():
+    validator = schema.Validator(schema.Object({"name": schema.String(nullable=True)}))
+    assert validator.validate({"name": None}) == {"name": None}
+    assert validator.validate({"name": "Max"}) == {"name": "Max"}
+    # Nullable fields still need to be present.
+    assert validator.validate({}) is None
+
+
+def test_optional_fields():
+    validator = schema.Validator(
+        schema.Object({"order_id": schema.Integer(), "limit": schema.Integer(minimum=1)}, optional=["limit"])
+    )
+    assert validator.validate({"order_id": 1}) == {"order_id": 1, "limit": None}
+    assert validator.validate({"order_id": 1, "limit": None}) == {"order_id": 1, "limit": None}
+    assert validator.validate({"order_id": 1, "limit": 5}) == {"order_id": 1, "limit": 5}
+    assert validator.validate({"order_id": 1, "limit": 0}) is None
+    assert validator.validate({"limit": 5}) is None
+
+
+def test_unknown_keys_are_dropped():
+    validator = schema.Validator(
+        schema.Object({"items": schema.List(schema.Object({"item_id": schema.Integer()}))})
+    )
+    value = {"items": [{"item_id": 1, "price": 5}], "extra": True}
+    assert validator.validate(value) == {"items": [{"item_id": 1}]}
+
+
+def test_violation_path():
+    check = schema.Object({"items": schema.List(schema.Object({"quantity": schema.Integer()}))}).compile()
+    with pytest.raises(SchemaViolation) as exc_info:
+        check({"items": [{"quantity": 1}, {"quantity": True}]})
+    assert exc_info.value.path == ["items", 1, "quantity"]
+    assert str(exc_info.value) == "Value at body['items'][1]['quantity'] must be an integer."
+
+    with pytest.raises(SchemaViolation) as exc_info:
+        check({"items": [{}]})
+    assert exc_info.value.path == ["items", 0, "quantity"]
+    assert exc_info.value.message == "is missing."